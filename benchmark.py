@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+Measures how many hashes per second the proof of work computes on one core, comparing the
+optimized nonce search to a straightforward loop over `Block.finish_hash` and
+`verify_proof_of_work`.
+"""
+
+__all__ = []
+
+import argparse
+import time
+
+from src.crypto import set_hash_backend, HASH_BACKENDS
+from src.block import Block
+from src.blockchain import Blockchain
+from src.proof_of_work import verify_proof_of_work, proof_of_work_target, search_nonce
+
+BATCH_SIZE = 1000
+""" The number of nonces that are tried between two checks of the elapsed time. """
+
+def reference_hash_rate(block: Block, duration: float) -> float:
+    """ Returns the hash rate of a loop that computes and verifies each block hash on its own. """
+    hasher = block.get_partial_hash()
+    block.nonce = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for _ in range(BATCH_SIZE):
+            block.hash = block.finish_hash(hasher.copy())
+            verify_proof_of_work(block)
+            block.nonce += 1
+    return block.nonce / (time.perf_counter() - start)
+
+def search_nonce_hash_rate(block: Block, duration: float) -> float:
+    """ Returns the hash rate of `search_nonce`. """
+    hasher = block.get_partial_hash()
+    target = proof_of_work_target(block.difficulty)
+    nonce = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        search_nonce(hasher, target, nonce, 1, BATCH_SIZE)
+        nonce += BATCH_SIZE
+    return nonce / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Proof of work benchmark.")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="The number of seconds each variant is measured.")
+    parser.add_argument("--hash-backend", choices=list(HASH_BACKENDS),
+                        help="The SHA-512 implementation to measure. Defaults to the fastest available one.")
+    args = parser.parse_args()
+    if args.hash_backend is not None:
+        set_hash_backend(args.hash_backend)
+
+    block = Block.create(Blockchain(), [])
+    # make sure no nonce is ever good enough, so that both variants compute all hashes
+    block.difficulty = 2 ** 510
+
+    reference = reference_hash_rate(block, args.duration)
+    optimized = search_nonce_hash_rate(block, args.duration)
+    print("reference:    {:10.0f} hashes/s".format(reference))
+    print("search_nonce: {:10.0f} hashes/s".format(optimized))
+    print("speedup:      {:10.2f}x".format(optimized / reference))
+
+if __name__ == '__main__':
+    main()
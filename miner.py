@@ -8,19 +8,21 @@ through a REST API by the wallet.
 __all__ = []
 
 import argparse
+import os
 from urllib.parse import urlparse
 from typing import Tuple
 
 import logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(message)s")
 
-from src.crypto import Signing
+from src.crypto import Signing, set_hash_backend, HASH_BACKENDS
 from src.protocol import Protocol
 from src.block import GENESIS_BLOCK
 from src.chainbuilder import ChainBuilder
 from src.mining import Miner
 from src.persistence import Persistence
 from src.rpc_server import rpc_server
+from src.signature_verification import set_worker_count
 
 def parse_addr_port(val: str) -> Tuple[str, int]:
     """ Parse a user-specified "host:port" value to a tuple. """
@@ -43,23 +45,38 @@ def main():
                         help="The port where the P2P server should listen. Defaults a dynamically assigned port.")
     parser.add_argument("--mining-pubkey", type=argparse.FileType('rb'),
                         help="The public key where mining rewards should be sent to. No mining is performed if this is left unspecified.")
+    parser.add_argument("--mining-workers", type=int, default=os.cpu_count() or 1,
+                        help="The number of processes used for mining. Defaults to the number of CPUs.")
+    parser.add_argument("--template-fee-delta", type=int,
+                        help="Rebuild the mined block once new transactions pay at least this much in fees.")
+    parser.add_argument("--template-interval", type=float,
+                        help="Rebuild the mined block with new transactions at most this many seconds after it was built.")
     parser.add_argument("--bootstrap-peer", action='append', type=parse_addr_port, default=[],
                         help="Addresses of other P2P peers in the network.")
     parser.add_argument("--rpc-port", type=int, default=40203,
                         help="The port number where the wallet can find an RPC server.")
     parser.add_argument("--persist-path",
                         help="The file where data is persisted.")
+    parser.add_argument("--verification-workers", type=int, default=os.cpu_count() or 1,
+                        help="The number of processes used to verify signatures. Defaults to the number of CPUs.")
+    parser.add_argument("--hash-backend", choices=list(HASH_BACKENDS),
+                        help="The SHA-512 implementation used for hashing. Defaults to the fastest available one.")
 
     args = parser.parse_args()
 
+    set_worker_count(args.verification_workers)
+    if args.hash_backend is not None:
+        set_hash_backend(args.hash_backend)
+
     proto = Protocol(args.bootstrap_peer, GENESIS_BLOCK, args.listen_port, args.listen_address)
     if args.mining_pubkey is not None:
         pubkey = Signing(args.mining_pubkey.read())
         args.mining_pubkey.close()
-        miner = Miner(proto, pubkey)
+        miner = Miner(proto, pubkey, args.mining_workers, args.template_fee_delta, args.template_interval)
         miner.start_mining()
         chainbuilder = miner.chainbuilder
     else:
+        miner = None
         chainbuilder = ChainBuilder(proto)
 
     if args.persist_path:
@@ -71,7 +88,7 @@ def main():
     else:
         persist = None
 
-    rpc_server(args.rpc_port, chainbuilder, persist)
+    rpc_server(args.rpc_port, chainbuilder, persist, miner)
 
 if __name__ == '__main__':
     main()
@@ -10,14 +10,12 @@ import math
 from .merkle import merkle_tree
 from .crypto import get_hasher
 
-__all__ = ['Block', 'GENESIS_BLOCK', 'GENESIS_BLOCK_HASH']
+__all__ = ['Block', 'BlockHeader', 'GENESIS_BLOCK', 'GENESIS_BLOCK_HASH']
 
-class Block:
+class BlockHeader:
     """
-    A block: a container for all the data associated with a block.
-
-    To figure out whether the block is valid on top of a block chain, there are a few `verify`
-    methods. Without calling these, you must assume the block was crafted maliciously.
+    The header of a block: all the data that its hash is computed from. Headers can be used to
+    verify the proof of work of a chain of blocks without knowing the transactions in the blocks.
 
     :ivar hash: The hash value of this block.
     :vartype hash: bytes
@@ -31,23 +29,17 @@ class Block:
     :vartype nonce: int
     :ivar height: The height (accumulated difficulty) of this block.
     :vartype height: int
-    :ivar received_time: The time when we received this block.
-    :vartype received_time: datetime
     :ivar difficulty: The difficulty of this block.
     :vartype difficulty: int
-    :ivar transactions: The list of transactions in this block.
-    :vartype transactions: List[Transaction]
     """
 
-    def __init__(self, prev_block_hash, time, nonce, height, received_time, difficulty, transactions, merkle_root_hash=None):
+    def __init__(self, prev_block_hash, time, nonce, height, difficulty, merkle_root_hash):
         self.prev_block_hash = prev_block_hash
         self.merkle_root_hash = merkle_root_hash
         self.time = time
         self.nonce = nonce
         self.height = height
-        self.received_time = received_time
         self.difficulty = difficulty
-        self.transactions = transactions
         self.hash = self._get_hash()
 
     def to_json_compatible(self):
@@ -59,36 +51,18 @@ class Block:
         val['nonce'] = self.nonce
         val['height'] = self.height
         val['difficulty'] = self.difficulty
-        val['transactions'] = [t.to_json_compatible() for t in self.transactions]
         return val
 
     @classmethod
     def from_json_compatible(cls, val):
-        """ Create a new block from its JSON-serializable representation. """
-        from .transaction import Transaction
+        """ Create a new block header from its JSON-serializable representation. """
         return cls(unhexlify(val['prev_block_hash']),
                    datetime.strptime(val['time'], "%Y-%m-%dT%H:%M:%S.%f UTC"),
                    int(val['nonce']),
                    int(val['height']),
-                   datetime.utcnow(),
                    int(val['difficulty']),
-                   [Transaction.from_json_compatible(t) for t in list(val['transactions'])],
                    unhexlify(val['merkle_root_hash']))
 
-    @classmethod
-    def create(cls, blockchain: 'Blockchain', transactions: list, ts=None):
-        """
-        Create a new block for a certain blockchain, containing certain transactions.
-        """
-        tree = merkle_tree(transactions)
-        difficulty = blockchain.compute_difficulty_next_block()
-        if ts is None:
-            ts = datetime.utcnow()
-        if ts <= blockchain.head.time:
-            ts = blockchain.head.time + timedelta(microseconds=1)
-        return Block(blockchain.head.hash, ts, 0, blockchain.head.height + difficulty,
-                     None, difficulty, transactions, tree.get_hash())
-
     def __str__(self):
         return json.dumps(self.to_json_compatible(), indent=4)
 
@@ -100,6 +74,15 @@ class Block:
         # the numbers (0xffff, 0x00) would be encoded identically to (0xff, 0xff00)
         return pack("<Q", l) + val.to_bytes(l, 'little', signed=True)
 
+    def get_partial_header(self) -> bytes:
+        """
+        Returns the hashed contents of this block, except for the nonce. Hashing these bytes
+        results in the same state as `get_partial_hash`.
+        """
+        return (self.prev_block_hash + self.merkle_root_hash +
+                self.time.strftime("%Y-%m-%dT%H:%M:%S.%f UTC").encode() +
+                self._int_to_bytes(self.difficulty))
+
     def get_partial_hash(self):
         """
         Computes a hash over the contents of this block, except for the nonce. The proof of
@@ -107,10 +90,7 @@ class Block:
         use `hash` to get the complete hash.
         """
         hasher = get_hasher()
-        hasher.update(self.prev_block_hash)
-        hasher.update(self.merkle_root_hash)
-        hasher.update(self.time.strftime("%Y-%m-%dT%H:%M:%S.%f UTC").encode())
-        hasher.update(self._int_to_bytes(self.difficulty))
+        hasher.update(self.get_partial_header())
         return hasher
 
     def finish_hash(self, hasher):
@@ -127,10 +107,6 @@ class Block:
         hasher = self.get_partial_hash()
         return self.finish_hash(hasher)
 
-    def verify_merkle(self):
-        """ Verify that the merkle root hash is correct for the transactions in this block. """
-        return merkle_tree(self.transactions).get_hash() == self.merkle_root_hash
-
     def verify_difficulty(self):
         """ Verifies that the hash value is correct and fulfills its difficulty promise. """
         if self.hash == GENESIS_BLOCK_HASH:
@@ -140,6 +116,79 @@ class Block:
             return False
         return True
 
+    def verify_time_after(self, prev_time: datetime):
+        """
+        Verifies that this block is not from far in the future, but a bit younger than its
+        predecessor, which was created at `prev_time`.
+        """
+        if self.time - timedelta(hours=2) > datetime.utcnow():
+            logging.warning("discarding block because it is from the far future")
+            return False
+        if self.time <= prev_time:
+            logging.warning("discarding block because it is younger than its predecessor")
+            return False
+        return True
+
+class Block(BlockHeader):
+    """
+    A block: a container for all the data associated with a block.
+
+    To figure out whether the block is valid on top of a block chain, there are a few `verify`
+    methods. Without calling these, you must assume the block was crafted maliciously.
+
+    :ivar received_time: The time when we received this block.
+    :vartype received_time: datetime
+    :ivar transactions: The list of transactions in this block.
+    :vartype transactions: List[Transaction]
+    """
+
+    def __init__(self, prev_block_hash, time, nonce, height, received_time, difficulty, transactions, merkle_root_hash=None):
+        self.received_time = received_time
+        self.transactions = transactions
+        super().__init__(prev_block_hash, time, nonce, height, difficulty, merkle_root_hash)
+
+    def to_json_compatible(self):
+        """ Returns a JSON-serializable representation of this object. """
+        val = super().to_json_compatible()
+        val['transactions'] = [t.to_json_compatible() for t in self.transactions]
+        return val
+
+    @classmethod
+    def from_json_compatible(cls, val):
+        """ Create a new block from its JSON-serializable representation. """
+        from .transaction import Transaction
+        return cls(unhexlify(val['prev_block_hash']),
+                   datetime.strptime(val['time'], "%Y-%m-%dT%H:%M:%S.%f UTC"),
+                   int(val['nonce']),
+                   int(val['height']),
+                   datetime.utcnow(),
+                   int(val['difficulty']),
+                   [Transaction.from_json_compatible(t) for t in list(val['transactions'])],
+                   unhexlify(val['merkle_root_hash']))
+
+    @classmethod
+    def create(cls, blockchain: 'Blockchain', transactions: list, ts=None):
+        """
+        Create a new block for a certain blockchain, containing certain transactions.
+        """
+        tree = merkle_tree(transactions)
+        difficulty = blockchain.compute_difficulty_next_block()
+        if ts is None:
+            ts = datetime.utcnow()
+        if ts <= blockchain.head.time:
+            ts = blockchain.head.time + timedelta(microseconds=1)
+        return Block(blockchain.head.hash, ts, 0, blockchain.head.height + difficulty,
+                     None, difficulty, transactions, tree.get_hash())
+
+    def get_header(self) -> BlockHeader:
+        """ Returns the header of this block, without its transactions. """
+        return BlockHeader(self.prev_block_hash, self.time, self.nonce, self.height,
+                           self.difficulty, self.merkle_root_hash)
+
+    def verify_merkle(self):
+        """ Verify that the merkle root hash is correct for the transactions in this block. """
+        return merkle_tree(self.transactions).get_hash() == self.merkle_root_hash
+
     def verify_prev_block(self, chain: 'Blockchain'):
         """ Verifies that the previous block pointer points to the head of the given block chain and difficulty and height are correct. """
         if chain.head.hash != self.prev_block_hash:
@@ -157,7 +206,10 @@ class Block:
         """ Verifies that all transaction in this block are valid in the given block chain. """
         mining_reward = None
 
-        trans_set = set(self.transactions)
+        # maps the coins spent in this block to the transaction spending them, so that double
+        # spends within this block can be detected without comparing all pairs of transactions
+        spent_coins = {}
+        signature_checks = []
         for t in self.transactions:
             if not t.inputs:
                 if mining_reward is not None:
@@ -165,8 +217,25 @@ class Block:
                     return False
                 mining_reward = t
 
-            if not t.verify(chain, trans_set - {t}):
+            for inp in t.inputs:
+                if spent_coins.setdefault(inp, t) is not t:
+                    logging.warning("Transaction may not spend the same coin as another transaction"
+                                    " in the same block.")
+                    return False
+
+            if not t.verify(chain, set(), check_signatures=False):
+                return False
+            checks = t.get_signature_checks(chain)
+            if checks is None:
                 return False
+            signature_checks.extend(checks)
+
+        # the signatures of all transactions are verified in one batch, so that they can be
+        # checked in parallel
+        if not all(verify_signatures(signature_checks)):
+            logging.warning("Transaction signature does not verify.")
+            return False
+
         if mining_reward is not None:
             fees = sum(t.get_transaction_fee(chain) for t in self.transactions)
             reward = chain.compute_blockreward_next_block()
@@ -181,20 +250,14 @@ class Block:
         Verifies that blocks are not from far in the future, but a bit younger
         than the head of `chain`.
         """
-        if self.time - timedelta(hours=2) > datetime.utcnow():
-            logging.warning("discarding block because it is from the far future")
-            return False
-        if self.time <= chain.head.time:
-            logging.warning("discarding block because it is younger than its predecessor")
-            return False
-        return True
+        return self.verify_time_after(chain.head.time)
 
     def verify(self, chain: 'Blockchain'):
         """
         Verifies that this block contains only valid data and can be applied on top of the block
         chain `chain`.
         """
-        assert self.hash not in chain.block_indices
+        assert chain.get_block_by_hash(self.hash) is None
         if self.height == 0:
             logging.warning("only the genesis block may have height=0")
             return False
@@ -203,6 +266,7 @@ class Block:
 
 from .proof_of_work import verify_proof_of_work, GENESIS_DIFFICULTY, DIFFICULTY_BLOCK_INTERVAL, \
         DIFFICULTY_TARGET_TIMEDELTA
+from .signature_verification import verify_signatures
 
 
 GENESIS_BLOCK = Block("None; {} {}".format(DIFFICULTY_BLOCK_INTERVAL,
@@ -0,0 +1,102 @@
+""" A cache of received blocks that keeps only the recently used ones in memory. """
+
+import json
+import os
+import os.path
+import tempfile
+from binascii import hexlify
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Callable, Optional
+
+__all__ = ['BlockCache', 'BLOCK_CACHE_SIZE']
+
+BLOCK_CACHE_SIZE = 2000
+""" The default maximum number of blocks a block cache keeps in memory. """
+
+class BlockCache(Mapping):
+    """
+    A mapping from block hashes to blocks. At most `max_blocks` blocks are kept in memory; when more
+    blocks are added, the least recently used ones are written to a directory on disk, from where
+    they are read again when they are needed.
+
+    Blocks for which `is_pinned` returns `True` are never moved to disk, even if that means that more
+    than `max_blocks` blocks stay in memory.
+
+    :ivar max_blocks: The maximum number of blocks in memory.
+    :vartype max_blocks: int
+    :ivar path: The directory where blocks are stored on disk.
+    :vartype path: str
+    :ivar is_pinned: A function returning whether the block with a certain hash needs to stay in
+                     memory.
+    :vartype is_pinned: Callable[[bytes], bool]
+    :ivar _blocks: The blocks in memory, the least recently used one first.
+    :vartype _blocks: OrderedDict[bytes, Block]
+    :ivar _on_disk: The hashes of the blocks stored on disk.
+    :vartype _on_disk: Set[bytes]
+    :ivar _tmpdir: The temporary directory used as `path`, if no path was given.
+    :vartype _tmpdir: Optional[tempfile.TemporaryDirectory]
+    :param path: The directory where blocks are stored on disk. Defaults to a temporary directory
+                 that is removed together with this cache.
+    """
+
+    def __init__(self, max_blocks: int=BLOCK_CACHE_SIZE, path: Optional[str]=None,
+                 is_pinned: Callable[[bytes], bool]=lambda block_hash: False):
+        self.max_blocks = max_blocks
+        self.is_pinned = is_pinned
+        self._tmpdir = None
+        if path is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix="blocks")
+            path = self._tmpdir.name
+        self.path = path
+        self._blocks = OrderedDict()
+        self._on_disk = set()
+
+    def _block_path(self, block_hash: bytes) -> str:
+        return os.path.join(self.path, hexlify(block_hash).decode())
+
+    def __getitem__(self, block_hash: bytes) -> 'Block':
+        block = self._blocks.get(block_hash)
+        if block is not None:
+            self._blocks.move_to_end(block_hash)
+            return block
+        if block_hash not in self._on_disk:
+            raise KeyError(block_hash)
+
+        with open(self._block_path(block_hash)) as f:
+            block = Block.from_json_compatible(json.load(f))
+        self._blocks[block_hash] = block
+        self._evict()
+        return block
+
+    def __contains__(self, block_hash) -> bool:
+        return block_hash in self._blocks or block_hash in self._on_disk
+
+    def __iter__(self):
+        yield from self._blocks
+        yield from (h for h in self._on_disk if h not in self._blocks)
+
+    def __len__(self):
+        return len(self._blocks) + len(self._on_disk.difference(self._blocks))
+
+    def __setitem__(self, block_hash: bytes, block: 'Block'):
+        self._blocks[block_hash] = block
+        self._blocks.move_to_end(block_hash)
+        self._evict()
+
+    def _evict(self):
+        """ Moves the least recently used unpinned blocks to disk until at most `max_blocks` are left. """
+        for _ in range(len(self._blocks)):
+            if len(self._blocks) <= self.max_blocks:
+                break
+            block_hash, block = self._blocks.popitem(last=False)
+            if self.is_pinned(block_hash):
+                # pinned blocks are treated as recently used, so they are not checked over and over
+                self._blocks[block_hash] = block
+                continue
+            if block_hash not in self._on_disk:
+                with open(self._block_path(block_hash), "w") as f:
+                    json.dump(block.to_json_compatible(), f)
+                self._on_disk.add(block_hash)
+
+from .block import Block
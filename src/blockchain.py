@@ -1,11 +1,15 @@
 """ Definition of block chains. """
 
-__all__ = ['Blockchain']
+__all__ = ['Blockchain', 'BlockUndo', 'compute_difficulty']
 import logging
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Sequence
 from fractions import Fraction
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Tuple
 
-from .proof_of_work import DIFFICULTY_BLOCK_INTERVAL, DIFFICULTY_TARGET_TIMEDELTA
+from .proof_of_work import DIFFICULTY_BLOCK_INTERVAL, DIFFICULTY_TARGET_TIMEDELTA, GENESIS_DIFFICULTY
+from .unspent_coins import UnspentCoins
 
 GENESIS_REWARD = 1000
 """ The reward that is available for the first `REWARD_HALF_LIFE` blocks, starting with the genesis block. """
@@ -13,6 +17,215 @@ GENESIS_REWARD = 1000
 REWARD_HALF_LIFE = 10000
 """ The number of blocks until the block reward is halved. """
 
+BlockUndo = namedtuple("BlockUndo", ["spent", "created"])
+"""
+The information needed to undo the changes a block made to the unspent coins of a block chain.
+
+:ivar spent: The coins spent by the block, mapped to the transaction targets that created them.
+:vartype spent: Dict[TransactionInput, TransactionTarget]
+:ivar created: The coins created by the block.
+:vartype created: List[TransactionInput]
+"""
+
+def compute_difficulty(block_count: int, head: 'BlockHeader',
+                       get_block: 'Callable[[int], BlockHeader]') -> int:
+    """
+    Compute the desired difficulty for the block following `head`, the last block of a chain of
+    `block_count` blocks. Only the headers of the blocks are needed for this: `get_block` returns
+    (the header of) the block with a certain index in that chain, and is only called when the
+    difficulty is adjusted.
+    """
+    target_timedelta = Fraction(int(DIFFICULTY_TARGET_TIMEDELTA.total_seconds() * 1000 * 1000))
+
+    if block_count % DIFFICULTY_BLOCK_INTERVAL != 0:
+        return head.difficulty
+
+    duration = head.time - get_block(block_count - DIFFICULTY_BLOCK_INTERVAL).time
+    duration = Fraction(int(duration.total_seconds() * 1000 * 1000))
+
+    prev_difficulty = Fraction(head.difficulty)
+    hash_rate = prev_difficulty * DIFFICULTY_BLOCK_INTERVAL / duration
+
+    new_difficulty = hash_rate * target_timedelta / DIFFICULTY_BLOCK_INTERVAL
+
+    # the genesis difficulty was very easy, dropping below it means there was a pause
+    # in mining, so let's start with a new difficulty!
+    if new_difficulty < GENESIS_DIFFICULTY:
+        new_difficulty = GENESIS_DIFFICULTY
+
+    return int(new_difficulty)
+
+MAX_BLOCK_STORE_DEPTH = 8
+""" The number of nested block stores after which a forked block store is flattened again. """
+
+class _BlockStore:
+    """
+    Append-only storage of blocks that is shared by all block chains that are a prefix of it.
+
+    When a block chain forks off in the middle of a store, the new branch gets a new store that
+    refers to the old one for all blocks before the fork.
+
+    :ivar parent: The store containing the first `offset` blocks, or `None`.
+    :vartype parent: Optional[_BlockStore]
+    :ivar offset: The index of the first block in `blocks`.
+    :vartype offset: int
+    :ivar blocks: The blocks in this store.
+    :vartype blocks: List[Block]
+    :ivar undo: The undo records of the blocks in this store, in the same order as `blocks`.
+    :vartype undo: List[BlockUndo]
+    :ivar indices: A dictionary from block hashes to the index of the blocks in this store.
+    :vartype indices: Dict[bytes, int]
+    :ivar history: A dictionary from public keys to the transactions in this store that send coins
+                   to them or spend coins sent to them, together with the index of their block.
+    :vartype history: Dict[Signing, List[Tuple[int, Transaction]]]
+    :ivar depth: The number of parents of this store.
+    :vartype depth: int
+    """
+
+    def __init__(self, parent: 'Optional[_BlockStore]'=None, offset: int=0):
+        self.parent = parent
+        self.offset = offset
+        self.blocks = []
+        self.undo = []
+        self.indices = {}
+        self.history = {}
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    def __len__(self):
+        return self.offset + len(self.blocks)
+
+    def append(self, block: 'Block', undo: BlockUndo):
+        """ Appends a block and its undo record at the end of this store. """
+        idx = len(self)
+        for t in block.transactions:
+            keys = {target.recipient_pk for target in t.targets}
+            keys.update(undo.spent[inp].recipient_pk for inp in t.inputs)
+            for key in keys:
+                self.history.setdefault(key, []).append((idx, t))
+
+        self.indices[block.hash] = idx
+        self.blocks.append(block)
+        self.undo.append(undo)
+
+    def _locate(self, idx: int) -> 'Tuple[_BlockStore, int]':
+        """ Returns the store containing the block at index `idx` and the index in that store. """
+        store = self
+        while idx < store.offset:
+            store = store.parent
+        return store, idx - store.offset
+
+    def get(self, idx: int) -> 'Block':
+        """ Returns the block at index `idx`. """
+        store, idx = self._locate(idx)
+        return store.blocks[idx]
+
+    def get_undo(self, idx: int) -> BlockUndo:
+        """ Returns the undo record of the block at index `idx`. """
+        store, idx = self._locate(idx)
+        return store.undo[idx]
+
+    def index_by_hash(self, hash_val: bytes, length: int) -> 'Optional[int]':
+        """ Returns the index of the block with hash `hash_val` among the first `length` blocks. """
+        store = self
+        while store is not None:
+            idx = store.indices.get(hash_val)
+            if idx is not None and idx < length:
+                return idx
+            length = store.offset
+            store = store.parent
+        return None
+
+    def get_history(self, pubkey: 'Signing', length: int) -> 'List[Tuple[int, Transaction]]':
+        """ Returns the history of `pubkey` (see `history`) in the first `length` blocks. """
+        parts = []
+        store = self
+        while store is not None:
+            entries = store.history.get(pubkey, [])
+            parts.append(entries[:bisect_left(entries, (length,))])
+            length = store.offset
+            store = store.parent
+        return [entry for part in reversed(parts) for entry in part]
+
+    def fork(self, length: int) -> '_BlockStore':
+        """
+        Returns a new store containing the first `length` blocks of this store.
+
+        Once the stores are nested `MAX_BLOCK_STORE_DEPTH` levels deep, the new store becomes a
+        child of the root store instead, and only the blocks of the nested stores are copied into
+        it. The root store holds the history up to the first fork, so this costs time proportional
+        to the number of blocks added since then, once every `MAX_BLOCK_STORE_DEPTH` forks.
+        """
+        if self.depth < MAX_BLOCK_STORE_DEPTH:
+            return _BlockStore(self, length)
+
+        nested = self
+        while nested.parent.parent is not None:
+            nested = nested.parent
+        offset = min(nested.offset, length)
+        store = _BlockStore(nested.parent, offset)
+        for idx in range(offset, length):
+            store.append(self.get(idx), self.get_undo(idx))
+        return store
+
+
+class BlockList(Sequence):
+    """
+    An immutable view of the first `length` blocks of a `_BlockStore`.
+
+    :param store: The store containing the blocks.
+    :param length: The number of blocks in this list.
+    """
+
+    def __init__(self, store: _BlockStore, length: int):
+        while store.offset >= length and store.parent is not None:
+            store = store.parent
+        self._store = store
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self._length))]
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError("block index out of range")
+        return self._store.get(idx)
+
+    def index_by_hash(self, hash_val: bytes) -> 'Optional[int]':
+        """ Returns the index of the block with the hash `hash_val`, or None if it cannot be found. """
+        return self._store.index_by_hash(hash_val, self._length)
+
+    def get_undo(self, idx: int) -> BlockUndo:
+        """ Returns the undo record of the block at index `idx`. """
+        assert 0 <= idx < self._length
+        return self._store.get_undo(idx)
+
+    def get_history(self, pubkey: 'Signing') -> 'List[Tuple[int, Transaction]]':
+        """
+        Returns all transactions in this list that send coins to `pubkey` or spend coins sent to
+        it, together with the index of their block, oldest first.
+        """
+        return self._store.get_history(pubkey, self._length)
+
+    def appended(self, block: 'Block', undo: BlockUndo) -> 'BlockList':
+        """ Returns a new list of blocks with `block` and its undo record appended at the end. """
+        store = self._store
+        if self._length == len(store):
+            store.append(block, undo)
+        elif store.get(self._length).hash != block.hash:
+            store = store.fork(self._length)
+            store.append(block, undo)
+        return BlockList(store, self._length + 1)
+
+    def truncated(self, length: int) -> 'BlockList':
+        """ Returns a list containing only the first `length` blocks of this list. """
+        assert 0 < length <= self._length
+        return BlockList(self._store, length)
+
+
 class Blockchain:
     """
     A block chain: a ordered, immutable list of valid blocks. The only ways to create a blockchain
@@ -20,22 +233,22 @@ class Blockchain:
     and the `try_append` method which creates a new block chain only if the given block is valid on
     top of `self`.
 
-    :ivar blocks: The blocks in this chain, oldest first.
-    :vartype blocks: List[Block]
-    :ivar block_indices: A dictionary allowing efficient lookup of the index of a block in this
-                         block chain by its hash value.
-    :vartype block_indices: Dict[bytes, int]
-    :ivar unspent_coins: A dictionary mapping from (allowed/available) transaction inputs
-                         to the transaction output that created this coin.
-    :vartype unspent_coins: Dict[TransactionInput, TransactionTarget]
+    :ivar blocks: The blocks in this chain, oldest first. The storage of these blocks is shared
+                  with all block chains this one was created from or that were created from it.
+    :vartype blocks: BlockList
+    :ivar unspent_coins: A mapping from (allowed/available) transaction inputs to the transaction
+                         output that created this coin. Shares most of its storage with the
+                         block chain this one was created from.
+    :vartype unspent_coins: UnspentCoins
     """
 
     def __init__(self):
-        self.blocks = [GENESIS_BLOCK]
+        store = _BlockStore()
+        store.append(GENESIS_BLOCK, BlockUndo({}, []))
+        self.blocks = BlockList(store, 1)
         assert self.blocks[0].height == 0
-        self.block_indices = {GENESIS_BLOCK_HASH: 0}
         assert not GENESIS_BLOCK.transactions
-        self.unspent_coins = {}
+        self.unspent_coins = UnspentCoins()
 
     def try_append(self, block: 'Block') -> 'Optional[Blockchain]':
         """
@@ -46,26 +259,77 @@ class Blockchain:
         if not block.verify(self):
             return None
 
-        unspent_coins = self.unspent_coins.copy()
-
+        delta = {}
+        undo = BlockUndo({}, [])
         for t in block.transactions:
             for inp in t.inputs:
-                assert inp in unspent_coins, "Aborting computation of unspent transactions because a transaction spent an unavailable coin."
-                del unspent_coins[inp]
+                outp = delta.get(inp, self.unspent_coins.get(inp))
+                assert outp is not None, "Aborting computation of unspent transactions because a transaction spent an unavailable coin."
+                delta[inp] = None
+                undo.spent[inp] = outp
             for i, target in enumerate(t.targets):
-                unspent_coins[TransactionInput(t.get_hash(), i)] = target
+                inp = TransactionInput(t.get_hash(), i)
+                delta[inp] = target
+                undo.created.append(inp)
 
         chain = Blockchain()
-        chain.unspent_coins = unspent_coins
-        chain.blocks = self.blocks + [block]
-        chain.block_indices = self.block_indices.copy()
-        chain.block_indices[block.hash] = len(self.blocks)
+        chain.unspent_coins = self.unspent_coins.apply(delta)
+        chain.blocks = self.blocks.appended(block, undo)
+
+        return chain
+
+    def rollback(self, hash_val: bytes) -> 'Optional[Blockchain]':
+        """
+        Returns the prefix of this block chain that ends with the block with hash `hash_val`, or
+        `None` if there is no such block in this chain.
 
+        The layers of the unspent coins that only describe removed blocks are dropped. The removed
+        blocks described by the next layer are undone using their undo records, and the changes
+        are merged into that layer, so that no changes of removed blocks stay reachable. Apart
+        from merging that layer, the cost is proportional to the number of removed blocks.
+        """
+        idx = self.blocks.index_by_hash(hash_val)
+        if idx is None:
+            return None
+        if idx == len(self.blocks) - 1:
+            return self
+
+        # the genesis block creates no coins, so the unspent coins describe the blocks after it
+        coins, block_count = self.unspent_coins.get_layer(idx)
+        if block_count > idx:
+            delta = {}
+            for i in range(block_count, idx, -1):
+                undo = self.blocks.get_undo(i)
+                for inp in undo.created:
+                    delta[inp] = None
+                delta.update(undo.spent)
+            coins = coins.revert(delta, block_count - idx)
+
+        chain = Blockchain()
+        chain.unspent_coins = coins
+        chain.blocks = self.blocks.truncated(idx + 1)
         return chain
 
+    def get_transaction_history(self, pubkey: 'Signing') -> 'List[Tuple[int, Transaction]]':
+        """
+        Returns all transactions in this chain that send coins to `pubkey` or spend coins sent to
+        it, together with the index of their block, oldest first.
+        """
+        return self.blocks.get_history(pubkey)
+
+    def common_prefix_length(self, other: 'Blockchain') -> int:
+        """
+        Returns the number of blocks at the start of this chain that are also part of `other`. The
+        cost is proportional to the number of blocks in this chain that are not part of `other`.
+        """
+        idx = len(self.blocks) - 1
+        while other.get_block_by_hash(self.blocks[idx].hash) is None:
+            idx -= 1
+        return idx + 1
+
     def get_block_by_hash(self, hash_val: bytes) -> 'Optional[Block]':
         """ Returns a block by its hash value, or None if it cannot be found. """
-        idx = self.block_indices.get(hash_val)
+        idx = self.blocks.index_by_hash(hash_val)
         if idx is None:
             return None
         return self.blocks[idx]
@@ -81,26 +345,7 @@ class Blockchain:
 
     def compute_difficulty_next_block(self) -> int:
         """ Compute the desired difficulty for the block following this chain's `head`. """
-        target_timedelta = Fraction(int(DIFFICULTY_TARGET_TIMEDELTA.total_seconds() * 1000 * 1000))
-
-        block_idx = len(self.blocks)
-        if block_idx % DIFFICULTY_BLOCK_INTERVAL != 0:
-            return self.head.difficulty
-
-        duration = self.head.time - self.blocks[block_idx - DIFFICULTY_BLOCK_INTERVAL].time
-        duration = Fraction(int(duration.total_seconds() * 1000 * 1000))
-
-        prev_difficulty = Fraction(self.head.difficulty)
-        hash_rate = prev_difficulty * DIFFICULTY_BLOCK_INTERVAL / duration
-
-        new_difficulty = hash_rate * target_timedelta / DIFFICULTY_BLOCK_INTERVAL
-
-        # the genesis difficulty was very easy, dropping below it means there was a pause
-        # in mining, so let's start with a new difficulty!
-        if new_difficulty < self.blocks[0].difficulty:
-            new_difficulty = self.blocks[0].difficulty
-
-        return int(new_difficulty)
+        return compute_difficulty(len(self.blocks), self.head, self.blocks.__getitem__)
 
     def compute_blockreward_next_block(self) -> int:
         """ Compute the block reward that is expected for the block following this chain's `head`. """
@@ -109,5 +354,5 @@ class Blockchain:
 
         return reward
 
-from .block import Block, GENESIS_BLOCK, GENESIS_BLOCK_HASH
+from .block import Block, BlockHeader, GENESIS_BLOCK, GENESIS_BLOCK_HASH
 from .transaction import TransactionInput, Transaction
@@ -6,35 +6,59 @@ but not yet part of the primary block chain, or valid once another unconfirmed t
 becomes valid.
 
 Received blocks that cannot be shown to be invalid on *any* block chain are stored in a block
-cache (from which for the moment they are never evicted), so that they do not need to be requested
-from other peers over and over again.
-
+cache, so that they do not need to be requested from other peers over and over again. The cache
+keeps only the recently used blocks in memory and moves the others to disk, except for the heads
+of checkpoints and the blocks of partial chains, which are needed again soon.
+
+Blocks are only downloaded for chains that are known to be longer than the primary block chain.
+When a block is announced whose parent we do not know, only the headers of its ancestors are
+requested at first. These are verified to form a chain with a valid proof of work, difficulty and
+height on top of our blocks, without looking at any transactions. Once the announced block is
+shown to extend such a header chain and to be higher than the primary block chain, the bodies of
+the missing blocks are requested; of several announced blocks waiting for headers, only the highest
+one is downloaded.
 
 For the process of building new primary block chains, block requests are used. These are maintained
 in a dict indexed by the hash of the next block that is required for the block request to make
 progress. Each block request stores a list of partial block chains that all depend on the same
 next block, and the time of the last download request, so that these requests can be retried and
-at some point aborted when no progress is made.
+at some point aborted when no progress is made. Our peers are asked for the missing block together
+with its ancestors, up to the heads of our checkpoints, which they send in batches of up to
+`BLOCKS_PER_REQUEST` blocks. Requests for blocks that turn out to be missing are only sent once a
+whole batch has been handled, so a chain of `N` missing blocks takes about
+`N / BLOCKS_PER_REQUEST` round trips instead of `N`.
 
 While not strictly necessary, the block requests are also used when the block can be found in the
 block cache. In that case they are immediately fulfilled until the block chains can be built or a
 block is missing in the cache, which then will be requested from the peers.
 
 Partial chains are completed once their next block is the head of a so called `checkpoint`. These
-checkpoints are snapshots of the primary block chain at various points in its history. For a chain
+checkpoints are blocks of the primary block chain at various points in its history. For a chain
 of length `N`, the number of checkpoints is always kept between `2*log_2(N)` and `log_2(N)`, with
 most checkpoints being relatively recent. There also is always one checkpoint with only the genesis
-block.
+block. Only the hashes of the checkpoints are stored: the state of the block chain at a checkpoint
+is recovered from the primary block chain when a partial chain needs it, so that the unspent coins
+at older points in time are not kept in memory.
+
+To build the new block chain for a completed partial chain, the primary block chain is rolled back
+to the last block it has in common with the partial chain, reusing the unspent coins it stores for
+that part of its history. Only the remaining blocks of the partial chain are then validated and
+applied.
+The transactions of the blocks that were rolled back are added to the unconfirmed transactions
+again, as long as they are still valid on the new primary block chain.
 """
 
 import threading
 import logging
 import math
-from typing import List, Dict, Callable, Optional
+from typing import List, Dict, Callable, Optional, Iterable, Set
 from datetime import datetime, timedelta
 
 from .block import GENESIS_BLOCK, GENESIS_BLOCK_HASH, Block
 from .blockchain import Blockchain
+from .mempool import Mempool
+from .block_cache import BlockCache
+from .header_chain import HeaderChain
 
 __all__ = ['ChainBuilder']
 
@@ -66,18 +90,21 @@ class BlockRequest:
         self._last_update = datetime(1970, 1, 1)
         self._request_count = 0
 
-    def send_request(self, protocol: 'Protocol'):
-        """ Sends a request for the next required block to the given `protocol`. """
+    def send_request(self, protocol: 'Protocol', locator: 'List[bytes]'):
+        """
+        Sends a request for the next required block and its ancestors to the given `protocol`.
+        The ancestors are requested up to the blocks in `locator`, which we already know.
+        """
         self._request_count += 1
         self._last_update = datetime.utcnow()
-        protocol.send_block_request(self.partial_chains[0][-1].prev_block_hash)
+        protocol.send_block_request(self.partial_chains[0][-1].prev_block_hash, locator)
         logging.debug("asking for another block %d (attempt %d)", max(len(r) for r in self.partial_chains), self._request_count)
 
     def timeout_reached(self) -> bool:
         """ Returns a bool indicating whether all attempts to download this block have failed. """
         return self._request_count > self.BLOCK_REQUEST_RETRY_COUNT
 
-    def checked_retry(self, protocol: 'Protocol'):
+    def checked_retry(self, protocol: 'Protocol', locator: 'List[bytes]'):
         """
         Retries sending this request, if no response was received for a certain time or if no
         request was sent yet.
@@ -87,7 +114,7 @@ class BlockRequest:
             if self._request_count >= self.BLOCK_REQUEST_RETRY_COUNT:
                 self._request_count += 1
             else:
-                self.send_request(protocol)
+                self.send_request(protocol, locator)
 
 class ChainBuilder:
     """
@@ -99,36 +126,62 @@ class ChainBuilder:
 
     :ivar primary_block_chain: The longest fully validated block chain we know of.
     :vartype primary_block_chain: Blockchain
+    :ivar _blockchain_checkpoints: The hashes of the heads of the checkpoints, all of which are
+                                   blocks of the primary block chain.
+    :vartype _blockchain_checkpoints: Set[bytes]
     :ivar _block_requests: A dict from block hashes to lists of partial chains waiting for that block.
     :vartype _block_requests: Dict[bytes, BlockRequest]
+    :ivar _header_chain: The verified headers of blocks building on the primary block chain.
+    :vartype _header_chain: HeaderChain
+    :ivar _announced_blocks: Received blocks whose ancestors' headers were requested, by hash.
+    :vartype _announced_blocks: Dict[bytes, Block]
+    :ivar _pending_headers: Received headers whose ancestors' headers were requested, oldest first,
+                            by the hash of the missing parent of the oldest one.
+    :vartype _pending_headers: Dict[bytes, List[BlockHeader]]
     :ivar block_cache: A cache of received blocks, not bound to any one specific block chain.
-    :vartype block_cache: Dict[bytes, Block]
+    :vartype block_cache: BlockCache
+    :ivar _partial_chain_blocks: The hashes of the blocks in partial chains, which the block cache
+                                 keeps in memory. May also contain blocks of partial chains that
+                                 were completed or discarded since the last call to
+                                 `_clean_block_requests`.
+    :vartype _partial_chain_blocks: Set[bytes]
     :ivar unconfirmed_transactions: Known transactions that are not part of the primary block chain.
-    :vartype unconfirmed_transactions: Dict[bytes, Transaction]
+                                    These are either valid on top of the primary block chain, or
+                                    spend coins created by other unconfirmed transactions.
+    :vartype unconfirmed_transactions: Mempool
     :ivar chain_change_handlers: Event handlers that get called when we find out about a new primary
                                  block chain.
     :vartype chain_change_handlers: List[Callable]
-    :ivar transaction_change_handlers: Event handlers that get called when we find out about a new
-                                       transaction.
+    :ivar transaction_change_handlers: Event handlers that get called with a new transaction when
+                                       it was added to the unconfirmed transactions.
     :vartype transaction_change_handlers: List[Callable]
     :ivar protocol: The protocol instance used by this chain builder.
     :vartype protocol: Protocol
     """
 
+    MAX_WAITING_FOR_HEADERS = 16
+    """ The maximum number of announced blocks and header lists that wait for missing headers. """
+
     def __init__(self, protocol: 'Protocol'):
         self.primary_block_chain = Blockchain()
         self._block_requests = {}
-        self._blockchain_checkpoints = { GENESIS_BLOCK_HASH: self.primary_block_chain }
+        self._blockchain_checkpoints = { GENESIS_BLOCK_HASH }
+
+        self._header_chain = HeaderChain(self.primary_block_chain)
+        self._announced_blocks = {}
+        self._pending_headers = {}
 
-        self.block_cache = { GENESIS_BLOCK_HASH: GENESIS_BLOCK }
-        self.unconfirmed_transactions = {}
-        # TODO: we want this to be sorted by some function of rewards and age
-        # TODO: we want two lists, one with known valid, unapplied transactions, the other with all known transactions (with some limit)
+        self._partial_chain_blocks = set()
+        self.block_cache = BlockCache(is_pinned=self._block_pinned)
+        self.block_cache[GENESIS_BLOCK_HASH] = GENESIS_BLOCK
+        self.unconfirmed_transactions = Mempool()
 
         self.chain_change_handlers = []
         self.transaction_change_handlers = []
 
         protocol.block_receive_handlers.append(self.new_block_received)
+        protocol.blocks_receive_handlers.append(self.new_blocks_received)
+        protocol.headers_receive_handlers.append(self.new_headers_received)
         protocol.trans_receive_handlers.append(self.new_transaction_received)
         protocol.block_request_handlers.append(self.block_request_received)
         self.protocol = protocol
@@ -140,6 +193,10 @@ class ChainBuilder:
             self._thread_id = threading.get_ident()
         assert self._thread_id == threading.get_ident()
 
+    def _block_pinned(self, block_hash: bytes) -> bool:
+        """ Returns whether the block cache needs to keep the block with hash `block_hash` in memory. """
+        return block_hash in self._blockchain_checkpoints or block_hash in self._partial_chain_blocks
+
     def block_request_received(self, block_hash: bytes) -> 'Optional[Block]':
         """ Our event handler for block requests in the protocol. """
         self._assert_thread_safety()
@@ -150,28 +207,84 @@ class ChainBuilder:
         self._assert_thread_safety()
         hash_val = transaction.get_hash()
 
-        def input_ok(inp):
-            return inp in self.primary_block_chain.unspent_coins or \
-                    inp.transaction_hash in self.unconfirmed_transactions
-
         if hash_val not in self.unconfirmed_transactions and \
-                all(input_ok(inp) for inp in transaction.inputs):
-            self.unconfirmed_transactions[hash_val] = transaction
+                self._unconfirmed_transaction_ok(transaction) and \
+                self.unconfirmed_transactions.add(transaction, self.primary_block_chain):
             self.protocol.broadcast_transaction(transaction)
             for handler in self.transaction_change_handlers:
-                handler()
+                handler(transaction)
+
+    def _unconfirmed_transaction_ok(self, transaction: 'Transaction') -> bool:
+        """
+        Checks whether `transaction` is valid on top of the primary block chain or, if it spends
+        coins of other unconfirmed transactions, whether all other coins it spends are available
+        and all its inputs are signed by the recipients of the coins.
+        """
+        unspent_coins = self.primary_block_chain.unspent_coins
+        if all(inp in unspent_coins for inp in transaction.inputs):
+            return transaction.verify(self.primary_block_chain, set())
+        if not all(inp in unspent_coins or inp.transaction_hash in self.unconfirmed_transactions
+                   for inp in transaction.inputs):
+            return False
+        checks = transaction.get_signature_checks(self.primary_block_chain, self.unconfirmed_transactions)
+        if checks is None:
+            return False
+        if not all(verify_signatures(checks)):
+            logging.warning("Transaction signature does not verify.")
+            return False
+        return True
+
+    def _revalidate_unconfirmed_transactions(self, hashes: 'Iterable[bytes]'):
+        """
+        Removes the unconfirmed transactions with the hashes in `hashes` if they are no longer
+        valid, as well as all unconfirmed transactions depending on removed transactions.
+        """
+        todo = list(hashes)
+        while todo:
+            hash_val = todo.pop()
+            entry = self.unconfirmed_transactions.get_entry(hash_val)
+            if entry is None or self._unconfirmed_transaction_ok(entry.transaction):
+                continue
+
+            todo.extend(entry.children)
+            self.unconfirmed_transactions.remove(hash_val)
+
+    def _restore_transactions(self, blocks: 'List[Block]'):
+        """
+        Adds the transactions of `blocks`, which were removed from the primary block chain, to the
+        unconfirmed transactions if they are still valid.
+        """
+        # The blocks are processed in chain order, so that transactions spending coins of
+        # transactions in earlier blocks find them among the unconfirmed transactions.
+        for block in blocks:
+            for trans in block.transactions:
+                if trans.inputs and trans.get_hash() not in self.unconfirmed_transactions and \
+                        self._unconfirmed_transaction_ok(trans):
+                    self.unconfirmed_transactions.add(trans, self.primary_block_chain)
 
     def _new_primary_block_chain(self, chain: 'Blockchain'):
         """ Does all the housekeeping that needs to be done when a new longest chain is found. """
         logging.info("new primary block chain with height %d with current difficulty %d", len(chain.blocks), chain.head.difficulty)
         self._assert_thread_safety()
+        old_chain = self.primary_block_chain
         self.primary_block_chain = chain
-        todelete = set()
-        for (hash_val, trans) in self.unconfirmed_transactions.items():
-            if not trans.verify(chain, set()):
-                todelete.add(hash_val)
-        for hash_val in todelete:
-            del self.unconfirmed_transactions[hash_val]
+        self._header_chain.set_chain(chain)
+
+        # The transactions of the removed blocks are restored first, so that unconfirmed
+        # transactions spending their coins stay valid. Apart from these, only unconfirmed
+        # transactions spending coins that were created or spent by the removed or the added blocks
+        # can have changed their validity.
+        common_length = chain.common_prefix_length(old_chain)
+        affected = set()
+        for block in old_chain.blocks[common_length:] + chain.blocks[common_length:]:
+            for trans in block.transactions:
+                coins = trans.inputs + [TransactionInput(trans.get_hash(), i) for i in range(len(trans.targets))]
+                for inp in coins:
+                    spender = self.unconfirmed_transactions.get_spender(inp)
+                    if spender is not None:
+                        affected.add(spender)
+        self._restore_transactions(old_chain.blocks[common_length:])
+        self._revalidate_unconfirmed_transactions(affected)
 
         for handler in self.chain_change_handlers:
             handler()
@@ -179,11 +292,9 @@ class ChainBuilder:
         self._retry_expired_requests()
         self._clean_block_requests()
 
-        # TODO: restore valid transactions from the old primary block chain
-
         self.protocol.broadcast_primary_block(chain.head)
 
-    def _build_blockchain(self, checkpoint: 'Blockchain', blocks: 'List[Block]'):
+    def _build_blockchain(self, checkpoint_hash: bytes, blocks: 'List[Block]'):
         def checkpoint_hashes(chain):
             chain_len = len(chain.blocks)
             idx = 0
@@ -194,30 +305,48 @@ class ChainBuilder:
                 yield chain.blocks[idx].hash
                 chain_len = chain_len - cp
 
-        chain = checkpoint
+        # Blocks that are already part of the primary block chain need not be applied again.
+        # Instead, the primary block chain is rolled back to the last common block (at the latest
+        # the checkpoint), so that the cost of switching to a fork mostly depends on the depth of
+        # the fork.
+        fork_idx = 0
+        while fork_idx < len(blocks) and \
+                self.primary_block_chain.get_block_by_hash(blocks[fork_idx].hash) is not None:
+            fork_idx += 1
+        fork_hash = blocks[fork_idx - 1].hash if fork_idx else checkpoint_hash
+        chain = self.primary_block_chain.rollback(fork_hash)
+        assert chain is not None, "checkpoints are always part of the primary block chain"
+
         checkpoints = self._blockchain_checkpoints.copy()
-        for b in blocks:
+        for b in blocks[fork_idx:]:
             next_chain = chain.try_append(b)
             if next_chain is None:
                 logging.warning("invalid block")
                 break
             chain = next_chain
-            checkpoints[chain.head.hash] = chain
+            checkpoints.add(chain.head.hash)
 
         if chain.head.height <= self.primary_block_chain.head.height:
             logging.warning("discarding shorter chain")
             return
 
-        for hash_val in checkpoints.keys() - set(checkpoint_hashes(next_chain)):
-            del checkpoints[hash_val]
+        checkpoints.intersection_update(checkpoint_hashes(chain))
         self._blockchain_checkpoints = checkpoints
         self._new_primary_block_chain(chain)
 
 
+    def _locator(self) -> 'List[bytes]':
+        """
+        Returns the hashes of the blocks at which our peers can stop sending ancestors of a
+        requested block: the heads of our checkpoints, where partial chains are completed.
+        """
+        return list(self._blockchain_checkpoints)
+
     def _retry_expired_requests(self):
         """ Sends new block requests to our peers for unanswered pending requests. """
+        locator = self._locator()
         for request in self._block_requests.values():
-            request.checked_retry(self.protocol)
+            request.checked_retry(self.protocol, locator)
 
     def _clean_block_requests(self):
         """
@@ -239,29 +368,118 @@ class ChainBuilder:
                 request.partial_chains = new_requests
                 block_requests[block_hash] = request
         self._block_requests = block_requests
+        self._partial_chain_blocks = {b.hash for r in block_requests.values()
+                                      for partial_chain in r.partial_chains for b in partial_chain}
 
-    def new_block_received(self, block: 'Block'):
-        """ Event handler that is called by the network layer when a block is received. """
+    def new_block_received(self, block: 'Block', local: bool=False):
+        """
+        Event handler that is called by the network layer when a block is received. The proof of
+        work and the Merkle root of the block need to be verified already.
+
+        :param local: Whether the block was sent by this program itself, e.g. when stored blocks
+                      are loaded (head first) on startup.
+        """
+        self.new_blocks_received([block], local)
+
+    def new_blocks_received(self, blocks: 'List[Block]', local: bool=False):
+        """
+        Event handler that is called by the network layer when several blocks are received, each
+        one usually being the parent of the one before. The proof of work and the Merkle root of
+        the blocks need to be verified already.
+
+        Requests for missing blocks are only sent once all blocks were handled, so that blocks
+        that are part of `blocks` are not requested again.
+        """
+        self._assert_thread_safety()
+        self._retry_expired_requests()
+
+        waiting_for = set()
+        for block in blocks:
+            block_hash = self._add_received_block(block, local)
+            if block_hash is not None:
+                waiting_for.add(block_hash)
+
+        locator = self._locator()
+        for block_hash in waiting_for:
+            # later blocks may have fulfilled the request already
+            request = self._block_requests.get(block_hash)
+            if request is not None:
+                request.checked_retry(self.protocol, locator)
+
+    def new_headers_received(self, headers: 'List[BlockHeader]'):
+        """
+        Event handler that is called by the network layer when block headers are received, each
+        one usually being the parent of the one before. The proof of work of the headers needs to
+        be verified already.
+        """
         self._assert_thread_safety()
-        if block.hash in self.block_cache or not block.verify_difficulty() or \
-                not block.verify_merkle():
+        headers = headers[::-1]
+        if headers[0].prev_block_hash not in self._header_chain:
+            self._pending_headers[headers[0].prev_block_hash] = headers
+            self._limit_waiting(self._pending_headers)
+            self.protocol.send_headers_request(headers[0].prev_block_hash, self._locator())
             return
-        self.block_cache[block.hash] = block
 
-        self._retry_expired_requests()
+        # headers that arrived earlier may have been waiting for these ones
+        while headers:
+            if not all(self._header_chain.add(header) for header in headers):
+                logging.warning("invalid block header")
+                break
+            headers = self._pending_headers.pop(headers[-1].hash, None)
+
+        ready = [b for b in self._announced_blocks.values() if b.prev_block_hash in self._header_chain]
+        for block in ready:
+            del self._announced_blocks[block.hash]
+        if ready:
+            self.new_blocks_received([max(ready, key=lambda b: b.height)])
+
+    def _limit_waiting(self, waiting: dict):
+        """ Removes the oldest entries of `waiting` until it has at most `MAX_WAITING_FOR_HEADERS` entries. """
+        while len(waiting) > self.MAX_WAITING_FOR_HEADERS:
+            del waiting[next(iter(waiting))]
+
+    def _add_received_block(self, block: 'Block', local: bool=False) -> Optional[bytes]:
+        """
+        Adds a received block to the block cache and to the partial chains waiting for it, and
+        builds new block chains if these are complete. Returns the hash of the block the partial
+        chains with this block wait for now, if any.
+
+        Blocks that were not requested are always accepted if they were sent by this program
+        itself, e.g. when stored blocks are loaded head first. Blocks that are not higher than the
+        primary block chain are only cached if they extend a cached block, as they may become part
+        of a longer fork later on. Higher blocks are accepted if they extend a cached block or
+        have a valid header on top of the known headers. If the headers of their ancestors are
+        missing, these are requested, and the block is not stored until they arrive.
+        """
+        if block.hash in self.block_cache:
+            return None
 
         if block.hash not in self._block_requests:
-            if block.height > self.primary_block_chain.head.height:
-                if block.hash not in self._block_requests:
-                    self._block_requests[block.hash] = BlockRequest()
+            if local:
+                self._block_requests[block.hash] = BlockRequest()
+            elif block.height <= self.primary_block_chain.head.height:
+                if block.prev_block_hash in self.block_cache:
+                    self.block_cache[block.hash] = block
+                return None
+            elif block.prev_block_hash in self.block_cache:
+                self._block_requests[block.hash] = BlockRequest()
+            elif block.prev_block_hash not in self._header_chain:
+                self._announced_blocks[block.hash] = block
+                self._limit_waiting(self._announced_blocks)
+                self.protocol.send_headers_request(block.prev_block_hash, self._locator())
+                return None
+            elif not self._header_chain.add(block.get_header()):
+                return None
             else:
-                return
+                self._block_requests[block.hash] = BlockRequest()
+        self.block_cache[block.hash] = block
 
         request = self._block_requests[block.hash]
         del self._block_requests[block.hash]
         while True:
             for partial_chain in request.partial_chains:
                 partial_chain.append(block)
+            self._partial_chain_blocks.add(block.hash)
             if block.prev_block_hash not in self.block_cache or block.prev_block_hash in self._blockchain_checkpoints:
                 break
             block = self.block_cache[block.prev_block_hash]
@@ -275,11 +493,12 @@ class ChainBuilder:
 
         if block.prev_block_hash in self._blockchain_checkpoints:
             del self._block_requests[block.prev_block_hash]
-            checkpoint = self._blockchain_checkpoints[block.prev_block_hash]
             for partial_chain in request.partial_chains:
-                self._build_blockchain(checkpoint, partial_chain[::-1])
-        request.checked_retry(self.protocol)
+                self._build_blockchain(block.prev_block_hash, partial_chain[::-1])
+            return None
+        return block.prev_block_hash
 
 from .protocol import Protocol
-from .block import Block
-from .transaction import Transaction
+from .block import Block, BlockHeader
+from .transaction import Transaction, TransactionInput
+from .signature_verification import verify_signatures
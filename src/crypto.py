@@ -3,18 +3,83 @@
 import os
 import os.path
 import tempfile
+import logging
 from binascii import hexlify, unhexlify
-from typing import Iterator, Iterable
+from typing import Iterator, Iterable, Callable
 
 from Crypto.Signature import PKCS1_PSS
 from Crypto.Hash import SHA512
 from Crypto.PublicKey import RSA
 
-__all__ = ['get_hasher', 'Signing', 'MAX_HASH']
+__all__ = ['get_hasher', 'set_hash_backend', 'HASH_BACKENDS', 'Signing', 'MAX_HASH']
+
+def _hashlib_sha512():
+    """ Returns the SHA-512 implementation of the standard library, which is usually OpenSSL's. """
+    import hashlib
+    return hashlib.sha512
+
+HASH_BACKENDS = {
+    'hashlib': _hashlib_sha512,
+    'pycrypto': lambda: SHA512.new,
+}
+"""
+The available implementations of SHA-512, as functions returning a factory for hash objects.
+Preferred backends come first.
+"""
+
+_SELF_TEST_VECTORS = [
+    (b"", "cf83e1357eefb8bdf1542850d66d8007d620e4050b5715dc83f4a921d36ce9ce"
+          "47d0d13c5d85f2b0ff8318d2877eec2f63b931bd47417a81a538327af927da3e"),
+    (b"abc", "ddaf35a193617abacc417349ae20413112e6fa4e89a97ea20a9eeee64b55d39a"
+             "2192992a274fc1a836ba3c23a3feebbd454d4423643ce80e2a9ac94fa54ca49f"),
+]
+""" Known SHA-512 digests used to check that a hash backend works correctly. """
+
+def _self_test(new_hasher: Callable) -> bool:
+    """ Checks that the hash objects created by `new_hasher` compute correct SHA-512 digests. """
+    for value, digest in _SELF_TEST_VECTORS:
+        hasher = new_hasher()
+        hasher.update(value[:1])
+        copy = hasher.copy()
+        hasher.update(b"garbage")
+        copy.update(value[1:])
+        if hexlify(copy.digest()).decode() != digest:
+            return False
+    return True
+
+_new_hasher = None
+
+def set_hash_backend(name: str):
+    """
+    Selects the implementation of SHA-512 returned by :func:`get_hasher`. By default, the first
+    backend in `HASH_BACKENDS` that is available and passes a self-test is used.
+
+    :param name: The name of a backend in `HASH_BACKENDS`.
+    :raises ValueError: If the backend does not exist, is not available or fails the self-test.
+    """
+    global _new_hasher
+    if name not in HASH_BACKENDS:
+        raise ValueError("unknown hash backend: " + name)
+    try:
+        new_hasher = HASH_BACKENDS[name]()
+    except (ImportError, AttributeError) as e:
+        raise ValueError("hash backend {} is not available".format(name)) from e
+    if not _self_test(new_hasher):
+        raise ValueError("hash backend {} failed its self-test".format(name))
+    _new_hasher = new_hasher
 
 def get_hasher():
     """ Returns a object that you can use for hashing, compatible to the `hashlib` interface. """
-    return SHA512.new()
+    return _new_hasher()
+
+for _name in HASH_BACKENDS:
+    try:
+        set_hash_backend(_name)
+        break
+    except ValueError:
+        logging.exception("cannot use hash backend %s", _name)
+else:
+    raise ImportError("no working SHA-512 implementation found")
 
 
 MAX_HASH = (1 << 512) - 1
@@ -34,14 +99,15 @@ class Signing:
     def verify_sign(self, hashed_value: bytes, signature: bytes) -> bool:
         """ Verify a signature for an already hashed value and a public key. """
         ver = PKCS1_PSS.new(self.rsa)
-        h = get_hasher()
+        # PKCS1_PSS needs a pycrypto hash object, regardless of the hash backend
+        h = SHA512.new()
         h.update(hashed_value)
         return ver.verify(h, signature)
 
     def sign(self, hashed_value: bytes) -> bytes:
         """ Sign a hashed value with this private key. """
         signer = PKCS1_PSS.new(self.rsa)
-        h = get_hasher()
+        h = SHA512.new()
         h.update(hashed_value)
         return signer.sign(h)
 
@@ -72,6 +138,19 @@ class Signing:
         """ Creates a new object of this class, from a JSON-serializable representation. """
         return cls(unhexlify(obj))
 
+    @classmethod
+    def _from_public_numbers(cls, n: int, e: int) -> 'Signing':
+        """ Creates a public key from its RSA modulus `n` and public exponent `e`. """
+        key = cls.__new__(cls)
+        key.rsa = RSA.construct((n, e))
+        return key
+
+    def __reduce__(self):
+        # public keys are pickled as numbers, which is a lot cheaper than exporting and importing them
+        if self.has_private:
+            return (Signing, (self.as_bytes(include_priv=True),))
+        return (Signing._from_public_numbers, (self.rsa.n, self.rsa.e))
+
     def __eq__(self, other: 'Signing'):
         return self.rsa.e == other.rsa.e and self.rsa.n == other.rsa.n
 
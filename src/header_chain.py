@@ -0,0 +1,103 @@
+""" A tree of block headers that are known to extend a block chain with valid proof of work. """
+
+import logging
+from typing import Dict, Optional, Tuple
+
+__all__ = ['HeaderChain']
+
+class HeaderChain:
+    """
+    Block headers building on the blocks of a block chain. Headers are only added when their
+    parent is known (either as a block of the block chain or as another header) and they are
+    valid on top of it: their proof of work, difficulty, height and time are checked, while the
+    transactions of their blocks are unknown.
+
+    This allows deciding which blocks are worth downloading before any of them is downloaded.
+
+    :ivar chain: The block chain the headers build on.
+    :vartype chain: Blockchain
+    :ivar _headers: The verified headers that are not part of `chain`, by their hash, together with
+                    the number of blocks before them in their chain.
+    :vartype _headers: Dict[bytes, Tuple[BlockHeader, int]]
+    """
+
+    def __init__(self, chain: 'Blockchain'):
+        self.chain = chain
+        self._headers = {}
+
+    def __contains__(self, block_hash: bytes) -> bool:
+        return self._lookup(block_hash) is not None
+
+    def __len__(self):
+        return len(self._headers)
+
+    def _lookup(self, block_hash: bytes) -> 'Optional[Tuple[BlockHeader, int]]':
+        """ Returns the header with hash `block_hash` and its index in its chain, if it is known. """
+        entry = self._headers.get(block_hash)
+        if entry is not None:
+            return entry
+        idx = self.chain.blocks.index_by_hash(block_hash)
+        if idx is None:
+            return None
+        return self.chain.blocks[idx], idx
+
+    def _ancestor(self, header: 'BlockHeader', idx: int, ancestor_idx: int) -> 'Optional[BlockHeader]':
+        """
+        Returns the ancestor at index `ancestor_idx` of `header`, which is at index `idx` of its
+        chain, or `None` if one of the headers in between is not known anymore.
+        """
+        while idx > ancestor_idx:
+            if self.chain.blocks.index_by_hash(header.hash) is not None:
+                return self.chain.blocks[ancestor_idx]
+            entry = self._lookup(header.prev_block_hash)
+            if entry is None:
+                return None
+            header, idx = entry
+        return header
+
+    def add(self, header: 'BlockHeader') -> bool:
+        """
+        Adds `header`, whose proof of work needs to be verified already, if it is valid on top of a
+        known header. Returns whether the header is known afterwards.
+        """
+        if header.hash in self:
+            return True
+        parent = self._lookup(header.prev_block_hash)
+        if parent is None:
+            return False
+        parent_header, parent_idx = parent
+
+        block_count = parent_idx + 1
+        def get_block(idx):
+            return self._ancestor(parent_header, parent_idx, idx)
+        if block_count % DIFFICULTY_BLOCK_INTERVAL == 0 and \
+                get_block(block_count - DIFFICULTY_BLOCK_INTERVAL) is None:
+            return False
+        difficulty = compute_difficulty(block_count, parent_header, get_block)
+
+        if header.difficulty != difficulty:
+            logging.warning("Block header has wrong difficulty.")
+            return False
+        if parent_header.height + header.difficulty != header.height:
+            logging.warning("Block header has wrong height.")
+            return False
+        if not header.verify_time_after(parent_header.time):
+            return False
+
+        self._headers[header.hash] = (header, parent_idx + 1)
+        return True
+
+    def set_chain(self, chain: 'Blockchain'):
+        """
+        Makes the headers build on `chain`. Headers of its blocks are not stored separately
+        anymore, and neither are headers that are not higher than its head, as these can no longer
+        lead to a longer chain (their descendants can, but their headers are requested again then).
+        """
+        self.chain = chain
+        self._headers = {h: (header, idx) for h, (header, idx) in self._headers.items()
+                         if header.height > chain.head.height and
+                         chain.blocks.index_by_hash(h) is None}
+
+from .blockchain import Blockchain, compute_difficulty
+from .block import BlockHeader
+from .proof_of_work import DIFFICULTY_BLOCK_INTERVAL
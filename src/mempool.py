@@ -0,0 +1,209 @@
+""" A size-bounded pool of unconfirmed transactions. """
+
+import heapq
+from collections.abc import Mapping
+from typing import Dict, List, Optional, Set
+
+__all__ = ['Mempool', 'MempoolEntry', 'MEMPOOL_MAX_SIZE']
+
+MEMPOOL_MAX_SIZE = 32 * 1024 * 1024
+""" The default maximum total size (in bytes of their JSON representation) of all transactions in a mempool. """
+
+class MempoolEntry:
+    """
+    An unconfirmed transaction together with the information the mempool keeps about it.
+
+    :ivar transaction: The transaction.
+    :vartype transaction: Transaction
+    :ivar fee: The transaction fee paid by the transaction.
+    :vartype fee: int
+    :ivar size: The size of the transaction, as computed by :func:`transaction_size`.
+    :vartype size: int
+    :ivar parents: The hashes of the unconfirmed transactions whose coins this transaction spends.
+    :vartype parents: Set[bytes]
+    :ivar children: The hashes of the unconfirmed transactions spending coins of this transaction.
+    :vartype children: Set[bytes]
+    """
+
+    def __init__(self, transaction: 'Transaction', fee: int, size: int):
+        self.transaction = transaction
+        self.fee = fee
+        self.size = size
+        self.parents = set()
+        self.children = set()
+
+    @property
+    def fee_rate(self) -> float:
+        """ The fee per byte of this transaction. """
+        return self.fee / self.size
+
+class Mempool(Mapping):
+    """
+    A mapping from transaction hashes to unconfirmed transactions. These are either valid on top of
+    a block chain, or spend coins created by other unconfirmed transactions.
+
+    Each coin can be spent by only one transaction in the pool: a transaction conflicting with
+    transactions in the pool is only added if it pays a higher fee per byte than each of them, in
+    which case these are removed together with all transactions depending on them.
+
+    The total size of the transactions is bounded by `max_size`. When a new transaction exceeds
+    this limit, the transactions with the lowest fee per byte are evicted (together with all
+    transactions depending on them) until the pool fits again.
+
+    :ivar max_size: The maximum total size of all transactions.
+    :vartype max_size: int
+    :ivar total_size: The total size of all transactions.
+    :vartype total_size: int
+    :ivar _entries: The entries of all transactions, indexed by transaction hash.
+    :vartype _entries: Dict[bytes, MempoolEntry]
+    :ivar _spends: A dict from coins to the hash of the transaction spending them.
+    :vartype _spends: Dict[TransactionInput, bytes]
+    :ivar _by_fee_rate: A heap of fee rates and hashes of the transactions, used to find the
+                        transaction with the lowest fee rate. Also contains removed transactions,
+                        which are skipped.
+    :vartype _by_fee_rate: List[Tuple[float, bytes]]
+    """
+
+    def __init__(self, max_size: int=MEMPOOL_MAX_SIZE):
+        self.max_size = max_size
+        self.total_size = 0
+        self._entries = {}
+        self._spends = {}
+        self._by_fee_rate = []
+
+    def __getitem__(self, hash_val: bytes) -> 'Transaction':
+        return self._entries[hash_val].transaction
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def copy(self) -> 'Dict[bytes, Transaction]':
+        """ Returns a dict of all transactions, indexed by transaction hash. """
+        return {hash_val: entry.transaction for hash_val, entry in self._entries.items()}
+
+    def get_entry(self, hash_val: bytes) -> Optional[MempoolEntry]:
+        """ Returns the entry of the transaction with the hash `hash_val`, if it is in the pool. """
+        return self._entries.get(hash_val)
+
+    def get_spender(self, inp: 'TransactionInput') -> Optional[bytes]:
+        """ Returns the hash of the transaction spending the coin `inp`, if there is one. """
+        return self._spends.get(inp)
+
+    def add(self, transaction: 'Transaction', chain: 'Blockchain') -> bool:
+        """
+        Adds `transaction`, whose inputs need to be unspent coins of `chain` or coins created by
+        transactions in the pool. Returns whether the transaction is part of the pool afterwards.
+        """
+        hash_val = transaction.get_hash()
+        if hash_val in self._entries:
+            return True
+
+        if len(set(transaction.inputs)) != len(transaction.inputs):
+            return False
+        input_amount = 0
+        parents = set()
+        for inp in transaction.inputs:
+            parent = self._entries.get(inp.transaction_hash)
+            if parent is not None:
+                if inp.output_idx >= len(parent.transaction.targets):
+                    return False
+                input_amount += parent.transaction.targets[inp.output_idx].amount
+                parents.add(inp.transaction_hash)
+            elif inp in chain.unspent_coins:
+                input_amount += chain.unspent_coins[inp].amount
+            else:
+                return False
+        fee = input_amount - sum(t.amount for t in transaction.targets)
+        if fee < 0:
+            return False
+        entry = MempoolEntry(transaction, fee, transaction_size(transaction))
+        if entry.size > self.max_size:
+            return False
+
+        # all checks happen before the conflicts are removed, so a rejected transaction leaves the
+        # pool unchanged
+        conflicts = {self._spends[inp] for inp in transaction.inputs if inp in self._spends}
+        if any(self._entries[c].fee_rate >= entry.fee_rate for c in conflicts):
+            return False
+        if not parents.isdisjoint(self._descendants(conflicts)):
+            return False
+        for conflict in conflicts:
+            self.remove(conflict, True)
+
+        entry.parents = parents
+        for parent in parents:
+            self._entries[parent].children.add(hash_val)
+        # transactions spending its coins may already be in the pool, e.g. when a transaction of a
+        # block that was rolled back is added again
+        for idx in range(len(transaction.targets)):
+            child = self._spends.get(TransactionInput(hash_val, idx))
+            if child is not None:
+                entry.children.add(child)
+                self._entries[child].parents.add(hash_val)
+        for inp in transaction.inputs:
+            self._spends[inp] = hash_val
+        self._entries[hash_val] = entry
+        self.total_size += entry.size
+        heapq.heappush(self._by_fee_rate, (entry.fee_rate, hash_val))
+
+        self._evict()
+        return hash_val in self._entries
+
+    def remove(self, hash_val: bytes, with_descendants: bool=False) -> 'List[Transaction]':
+        """
+        Removes the transaction with the hash `hash_val`, if it is in the pool, and returns the
+        removed transactions. Transactions depending on it are also removed if `with_descendants`
+        is set, otherwise they are kept (e.g. because the removed transaction was confirmed).
+        """
+        removed = []
+        todo = [hash_val]
+        while todo:
+            entry = self._entries.pop(todo.pop(), None)
+            if entry is None:
+                continue
+            trans = entry.transaction
+            removed.append(trans)
+            self.total_size -= entry.size
+            for inp in trans.inputs:
+                if self._spends.get(inp) == trans.get_hash():
+                    del self._spends[inp]
+            for parent in entry.parents:
+                if parent in self._entries:
+                    self._entries[parent].children.discard(trans.get_hash())
+            if with_descendants:
+                todo.extend(entry.children)
+            else:
+                for child in entry.children:
+                    self._entries[child].parents.discard(trans.get_hash())
+
+        # removed transactions are skipped lazily in the heap, which is rebuilt once most of it
+        # consists of them
+        if len(self._by_fee_rate) > 2 * len(self._entries) + 16:
+            self._by_fee_rate = [(e.fee_rate, h) for h, e in self._entries.items()]
+            heapq.heapify(self._by_fee_rate)
+        return removed
+
+    def _descendants(self, hashes: 'Set[bytes]') -> 'Set[bytes]':
+        """ Returns `hashes` together with the hashes of all transactions depending on them. """
+        descendants = set()
+        todo = list(hashes)
+        while todo:
+            hash_val = todo.pop()
+            if hash_val not in descendants:
+                descendants.add(hash_val)
+                todo.extend(self._entries[hash_val].children)
+        return descendants
+
+    def _evict(self):
+        """ Removes the transactions with the lowest fee rates until the pool fits into `max_size`. """
+        while self.total_size > self.max_size:
+            _, hash_val = heapq.heappop(self._by_fee_rate)
+            if hash_val in self._entries:
+                self.remove(hash_val, True)
+
+from .mining_strategy import transaction_size
+from .transaction import Transaction, TransactionInput
+from .blockchain import Blockchain
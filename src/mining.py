@@ -2,16 +2,19 @@
 
 import json
 import os
-import sys
 import signal
-import time
 import select
+import time
+from binascii import hexlify, unhexlify
+from datetime import datetime
+from collections import deque
 from threading import Thread, Condition
 from typing import Optional, Callable, Tuple, List
 
-from .proof_of_work import ProofOfWork
+from .proof_of_work import proof_of_work_target, search_nonce, verify_proof_of_work
 from .chainbuilder import ChainBuilder
 from .block import Block
+from .crypto import get_hasher
 from . import mining_strategy
 
 __all__ = ['Miner']
@@ -20,76 +23,154 @@ __all__ = ['Miner']
 
 signal.signal(signal.SIGCHLD, signal.SIG_IGN)
 
-def exit_on_pipe_close(pipe):
-    """ Waits until the pipe `pipe` can no longer be used, then kills this process. """
-    poller = select.poll()
-    poller.register(pipe, select.POLLERR)
-    poller.poll()
-    os._exit(1)
+BATCH_SIZE = 1000
+""" The number of nonces a worker process tries between two checks for new work. """
+REPORT_INTERVAL = 1.0
+""" The number of seconds between two reports of the number of hashes a worker process computed. """
+HASHRATE_WINDOW = 30.0
+""" The number of seconds of hash reports used to compute the current hash rate. """
 
+def send_message(pipe: int, msg):
+    """ Writes the JSON-serializable object `msg` as one line to the pipe `pipe`. """
+    os.write(pipe, json.dumps(msg).encode() + b"\n")
+
+class MessageReader:
+    """
+    Reads the messages written by :func:`send_message` from a pipe.
 
-def start_process(func: Callable) -> Tuple[int, int]:
+    :ivar pipe: The pipe messages are read from.
+    :vartype pipe: int
+    :ivar _buffer: Data that was read from the pipe, but does not form a complete message yet.
+    :vartype _buffer: bytes
     """
-    Starts a function in a forked process, and writes its result to a pipe.
 
-    :param func: The function the background process should run.
-    :rval: A tuple of the pipe where the result will be written to and the process id of the
-           forked process.
+    def __init__(self, pipe: int):
+        self.pipe = pipe
+        self._buffer = b""
+
+    def read(self, timeout: Optional[float]=None) -> list:
+        """
+        Waits at most `timeout` seconds (or indefinitely, if it is `None`) for data on the pipe and
+        returns all messages that were received completely, which may be none at all.
+
+        :raises EOFError: When the other end of the pipe was closed.
+        """
+        ready, _, _ = select.select([self.pipe], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.pipe, 65536)
+        if not data:
+            raise EOFError()
+        *lines, self._buffer = (self._buffer + data).split(b"\n")
+        return [json.loads(line.decode()) for line in lines]
+
+def start_process(func: Callable[[int, int], None]) -> Tuple[int, int, int]:
     """
-    rx, wx = os.pipe()
+    Starts a function in a forked process, connected to this process with two pipes.
+
+    :param func: The function the background process should run. It gets the pipe to read from and
+                 the pipe to write to as arguments. The process exits once the function returns.
+    :rval: A tuple of the pipe to write to the process, the pipe to read from the process and the
+           process id of the forked process.
+    """
+    rx, child_wx = os.pipe()
+    child_rx, wx = os.pipe()
     pid = os.fork()
     if pid == 0: # child
         try:
             os.close(0)
-            os.closerange(3, wx)
-            os.closerange(wx + 1, 2**16)
-
-            Thread(target=exit_on_pipe_close, args=(wx,), daemon=True).start()
+            keep = sorted([child_rx, child_wx])
+            os.closerange(3, keep[0])
+            os.closerange(keep[0] + 1, keep[1])
+            os.closerange(keep[1] + 1, 2**16)
 
-            res = func().to_json_compatible()
-            with os.fdopen(wx, "w") as fp:
-                json.dump(res, sys.stdout)
-                json.dump(res, fp)
+            func(child_rx, child_wx)
         except Exception:
             import traceback
             traceback.print_exc()
             os._exit(1)
         os._exit(0)
     else: # parent
-        os.close(wx)
-        return rx, pid
+        os.close(child_rx)
+        os.close(child_wx)
+        return wx, rx, pid
 
-def wait_for_result(pipes: List[int], cls: type):
+def mining_worker(work_pipe: int, result_pipe: int):
     """
-    Waits for one of the pipes in `pipes` to become ready, reads a JSON object from that pipe
-    and calls `cls.from_json_compatible()` to build the return value.
-    All pipes are closed once this function returns.
+    The main loop of a mining worker process.
 
-    :param pipes: The list of pipes to wait for.
-    :param cls: The class (with a `from_json_compatible` method) to return instances of.
-    :rtype: An instance of `cls`.
-    """
-    ready, _, _ = select.select(pipes, [], [])
-    for p in pipes:
-        if p != ready[0]:
-            os.close(p)
+    The worker receives work messages through `work_pipe`, each one describing a block header
+    without its nonce and the part of the nonce space this worker should search. New work
+    replaces the current work immediately. When a nonce satisfying the proof of work is found,
+    it is sent back through `result_pipe` together with the id of the work, and the worker waits
+    for new work. The worker exits when `work_pipe` is closed.
 
-    with os.fdopen(ready[0], "r") as fp:
-        return cls.from_json_compatible(json.load(fp))
+    Every `REPORT_INTERVAL` seconds, and whenever it switches to new work, the worker also reports
+    the number of hashes it computed since its last report, together with the id of its current
+    work.
+    """
+    reader = MessageReader(work_pipe)
+    work = None
+    hashes = 0
+    last_report = time.monotonic()
+    while True:
+        try:
+            messages = reader.read(0 if work is not None else None)
+        except EOFError:
+            return
+        if messages:
+            work = messages[-1]
+            send_message(result_pipe, {'work_id': work['work_id'], 'hashes': hashes})
+            hashes = 0
+            last_report = time.monotonic()
+            hasher = get_hasher()
+            hasher.update(unhexlify(work['header']))
+            target = proof_of_work_target(work['difficulty'])
+            nonce = work['first_nonce']
+        if work is None:
+            continue
+
+        found = search_nonce(hasher, target, nonce, work['nonce_step'], BATCH_SIZE)
+        nonce += BATCH_SIZE * work['nonce_step']
+        if found is not None:
+            hashes += (found - nonce) // work['nonce_step'] + BATCH_SIZE + 1
+            send_message(result_pipe, {'work_id': work['work_id'], 'nonce': found})
+            work = None
+            continue
+
+        hashes += BATCH_SIZE
+        if time.monotonic() - last_report >= REPORT_INTERVAL:
+            send_message(result_pipe, {'work_id': work['work_id'], 'hashes': hashes})
+            hashes = 0
+            last_report = time.monotonic()
 
 class Miner:
     """
-    Management of a background process that mines for new blocks.
+    Management of background processes that mine for new blocks.
 
-    The miner process is forked for each new proof of work that needs to be performed. The
-    completed block is sent back JSON-serialized through a pipe that is opened for that purpose.
-    When that pipe is closed by the parent process prematurely, the proof of work process knows it
-    is no longer needed and exits.
+    The worker processes are forked once, when mining starts, with each worker trying a different
+    part of the nonce space. Every time the block to mine changes, the workers are sent the new
+    block header (without the nonce) through a pipe and switch to it without being restarted. A
+    worker that finds a valid nonce sends it back through a second pipe, and the block is
+    completed and broadcast by a thread of this process. A worker exits once its work pipe is
+    closed, but as other processes forked later on may keep the pipe open, `shutdown` also kills
+    the workers.
 
     To start the mining process, `start_mining` needs to be called once. After that, the mining
     will happen automatically, with the mined block switching every time the chainbuilder finds a
     new primary block chain.
 
+    Optionally, the block is also updated while the chain stays the same, so that the workers always
+    mine the most profitable block. When new unconfirmed transactions arrive, the block is rebuilt
+    once their fees add up to at least `template_fee_delta`, or once `template_interval` seconds
+    have passed since the block was built (which is checked by the thread reading the results of the
+    workers, even if no further transactions arrive). The new block header is sent to the running
+    workers like any other work.
+
+    The workers regularly report how many hashes they computed. Together with the number of
+    blocks found and the time it took the workers to switch to a new block after the primary chain
+    changed, these can be queried with `mining_info`.
+
     To stop the mining process, there is the `shutdown` method. Once stopped, mining cannot be
     resumed (except by creating a new `Miner`).
 
@@ -97,97 +178,270 @@ class Miner:
     :vartype proto: Protocol
     :ivar chainbuilder: The chain builder used by :any:`start_mining` to find the primary chain.
     :vartype chainbuilder: ChainBuilder
-    :ivar _cur_miner_pipes: Pipes where worker processes will write their results to.
-    :vartype _cur_miner_pipes: Optional[List[int]]
-    :ivar _cur_miner_pids: Process ids of our worker processes.
-    :vartype _cur_miner_pids: List[int]
+    :ivar _work_pipes: Pipes where work for the worker processes is written to.
+    :vartype _work_pipes: List[int]
+    :ivar _result_pipes: Pipes where worker processes will write their results to.
+    :vartype _result_pipes: List[int]
+    :ivar _worker_pids: Process ids of our worker processes.
+    :vartype _worker_pids: List[int]
+    :ivar _cur_work_id: The id of the work the worker processes are currently doing.
+    :vartype _cur_work_id: int
+    :ivar _cur_block: The block the worker processes are currently mining, or `None` if a block was
+                      found already.
+    :vartype _cur_block: Optional[Block]
     :ivar reward_pubkey: The public key to which mining fees and block rewards should be sent to.
     :vartype reward_pubkey: Signing
+    :ivar worker_count: The number of worker processes that mine in parallel.
+    :vartype worker_count: int
+    :ivar template_fee_delta: The sum of the fees of new transactions for which the block is
+                              rebuilt, or `None`.
+    :vartype template_fee_delta: Optional[int]
+    :ivar template_interval: The number of seconds after which the block is rebuilt if there are new
+                             transactions, or `None`.
+    :vartype template_interval: Optional[float]
+    :ivar _pending_transactions: The number of transactions that arrived since the current block
+                                 was built.
+    :vartype _pending_transactions: int
+    :ivar _pending_fees: The sum of the fees of transactions that arrived since the current block
+                         was built.
+    :vartype _pending_fees: int
+    :ivar _template_time: The time (as returned by `time.monotonic`) when the current block was built.
+    :vartype _template_time: float
+    :ivar total_hashes: The number of hashes the worker processes computed so far.
+    :vartype total_hashes: int
+    :ivar blocks_found: The number of blocks that were mined and broadcast.
+    :vartype blocks_found: int
+    :ivar stale_blocks: The number of valid nonces that were found for a block that was not mined
+                        anymore.
+    :vartype stale_blocks: int
+    :ivar new_work_delay: The number of seconds between the last change of the primary chain and the
+                          time all worker processes reported they switched to the new block, or
+                          `None` if that has not happened yet.
+    :vartype new_work_delay: Optional[float]
+    :ivar _hash_reports: The times (as returned by `time.monotonic`) and numbers of hashes of the
+                         reports of the worker processes in the last `HASHRATE_WINDOW` seconds.
+    :vartype _hash_reports: Deque[Tuple[float, int]]
+    :ivar _mining_start: The time (as returned by `time.monotonic`) when the workers were started.
+    :vartype _mining_start: float
+    :ivar _chain_change_work_id: The id of the work started because of the last change of the
+                                 primary chain, if not all workers reported they switched to it yet.
+    :vartype _chain_change_work_id: Optional[int]
+    :ivar _chain_change_time: The time (as returned by `time.monotonic`) of the last change of the
+                              primary chain.
+    :vartype _chain_change_time: float
+    :ivar _chain_change_acks: The indices of the workers that reported they switched to the work
+                              started because of the last change of the primary chain (or to newer
+                              work).
+    :vartype _chain_change_acks: Set[int]
+    :param worker_count: The number of worker processes that mine in parallel. Defaults to the
+                         number of CPUs.
+    :param template_fee_delta: The sum of the fees of new transactions for which the block is
+                               rebuilt. Defaults to not rebuilding the block because of fees.
+    :param template_interval: The number of seconds after which the block is rebuilt if there are
+                              new transactions. Defaults to not rebuilding the block periodically.
     """
 
-    def __init__(self, proto, reward_pubkey):
+    def __init__(self, proto, reward_pubkey, worker_count: int=None,
+                 template_fee_delta: Optional[int]=None, template_interval: Optional[float]=None):
         self.proto = proto
+        self.worker_count = worker_count or os.cpu_count() or 1
+        self.template_fee_delta = template_fee_delta
+        self.template_interval = template_interval
         self.chainbuilder = ChainBuilder(proto)
         self.chainbuilder.chain_change_handlers.append(self._chain_changed)
-        self._cur_miner_pids = []
-        self._cur_miner_pipes = None
+        self.chainbuilder.transaction_change_handlers.append(self._transactions_changed)
+        self._pending_transactions = 0
+        self._pending_fees = 0
+        self._template_time = 0.0
+        self.total_hashes = 0
+        self.blocks_found = 0
+        self.stale_blocks = 0
+        self.new_work_delay = None
+        self._hash_reports = deque()
+        self._mining_start = 0.0
+        self._chain_change_work_id = None
+        self._chain_change_time = 0.0
+        self._chain_change_acks = set()
+        self._work_pipes = []
+        self._result_pipes = []
+        self._worker_pids = []
+        self._cur_work_id = 0
+        self._cur_block = None
         self.reward_pubkey = reward_pubkey
         self._stopped = False
         self._started = False
         self._miner_cond = Condition()
 
     def _miner_thread(self):
-        def wait_for_miner():
-            with self._miner_cond:
-                while self._cur_miner_pipes is None:
-                    if self._stopped:
-                        return None, None
-                    self._miner_cond.wait()
-                pipes = self._cur_miner_pipes
-                pids = self._cur_miner_pids
-                self._cur_miner_pipes = None
-                return pipes, pids
-
-        while True:
-            rxs, pids = wait_for_miner()
-            if rxs is None:
-                return
-
-            try:
-                block = wait_for_result(rxs, Block)
-                self.proto.broadcast_primary_block(block)
-            except json.JSONDecodeError:
-                pass
-
-            with self._miner_cond:
-                if self._cur_miner_pids == pids:
-                    for pid in pids:
-                        try:
-                            os.kill(pid, signal.SIGKILL)
-                        except ProcessLookupError:
-                            pass
-                    self._cur_miner_pids = []
+        readers = {pipe: MessageReader(pipe) for pipe in self._result_pipes}
+        worker_indices = {pipe: i for i, pipe in enumerate(self._result_pipes)}
+        timeout = None if self.template_interval is None else min(self.template_interval, 1.0)
+        while readers:
+            ready, _, _ = select.select(list(readers), [], [], timeout)
+            if self.template_interval is not None and self._template_outdated():
+                self.proto.call_in_main_thread(self._rebuild_outdated_template)
+            for pipe in ready:
+                try:
+                    messages = readers[pipe].read(0)
+                except EOFError:
+                    os.close(pipe)
+                    del readers[pipe]
+                    continue
+                for msg in messages:
+                    if 'hashes' in msg:
+                        self._hashes_reported(worker_indices[pipe], msg['work_id'], msg['hashes'])
+                        continue
+                    block = self._complete_block(msg['work_id'], msg['nonce'])
+                    if block is not None:
+                        self.proto.broadcast_primary_block(block)
+
+    def _hashes_reported(self, worker: int, work_id: int, hashes: int):
+        """ Records the hashes reported by the worker with index `worker`, which is working on the work `work_id`. """
+        now = time.monotonic()
+        with self._miner_cond:
+            self.total_hashes += hashes
+            self._hash_reports.append((now, hashes))
+            while self._hash_reports[0][0] < now - HASHRATE_WINDOW:
+                self._hash_reports.popleft()
+
+            # the block may have been rebuilt since the chain changed, in which case the workers
+            # switch to the newer work right away
+            if self._chain_change_work_id is not None and work_id >= self._chain_change_work_id:
+                self._chain_change_acks.add(worker)
+                if len(self._chain_change_acks) == self.worker_count:
+                    self.new_work_delay = now - self._chain_change_time
+                    self._chain_change_work_id = None
+
+    def mining_info(self) -> dict:
+        """
+        Returns statistics about the mining as a JSON-compatible dict: the current hash rate (in
+        hashes per second), the total number of hashes, the number of blocks found, the number of
+        stale blocks and the number of seconds the workers needed to switch to a new block after
+        the last change of the primary chain.
+        """
+        with self._miner_cond:
+            now = time.monotonic()
+            window = min(HASHRATE_WINDOW, now - self._mining_start)
+            recent = sum(h for t, h in self._hash_reports if t >= now - HASHRATE_WINDOW)
+            return {
+                'hashrate': recent / window if self._started and window > 0 else 0.0,
+                'total_hashes': self.total_hashes,
+                'blocks_found': self.blocks_found,
+                'stale_blocks': self.stale_blocks,
+                'new_work_delay': self.new_work_delay,
+                'workers': self.worker_count,
+            }
+
+    def _complete_block(self, work_id: int, nonce: int) -> Optional[Block]:
+        """ Returns the current block with the nonce found by a worker, if it is still needed. """
+        with self._miner_cond:
+            if work_id != self._cur_work_id or self._cur_block is None:
+                self.stale_blocks += 1
+                return None
+            template = self._cur_block
+            self._cur_block = None
+            self.blocks_found += 1
+
+        block = Block(template.prev_block_hash, template.time, nonce, template.height,
+                      datetime.utcnow(), template.difficulty, template.transactions,
+                      template.merkle_root_hash)
+        assert verify_proof_of_work(block)
+        return block
+
+    def _start_workers(self):
+        for _ in range(self.worker_count):
+            wx, rx, pid = start_process(mining_worker)
+            self._work_pipes.append(wx)
+            self._result_pipes.append(rx)
+            self._worker_pids.append(pid)
+        self._mining_start = time.monotonic()
+        Thread(target=self._miner_thread, daemon=True).start()
 
     def start_mining(self):
         """ Start mining on a new block. """
         with self._miner_cond:
+            if self._stopped:
+                return
             if not self._started:
-                Thread(target=self._miner_thread, daemon=True).start()
+                self._start_workers()
             self._started = True
             # TODO: accessing the chainbuilder is problematic if start_mining was not called from the protocol's main thread
             chain = self.chainbuilder.primary_block_chain
-            transactions = self.chainbuilder.unconfirmed_transactions.values()
-            block = mining_strategy.create_block(chain, transactions, self.reward_pubkey)
-            self._stop_mining_for_now()
-            self._cur_miner_pipes = []
-
-            miner = ProofOfWork(block)
-            rx, pid = start_process(miner.run)
-            self._cur_miner_pids.append(pid)
-            self._cur_miner_pipes.append(rx)
-
-            self._miner_cond.notify()
+            transactions = self.chainbuilder.unconfirmed_transactions
+            block = mining_strategy.create_block(chain, transactions.values(), self.reward_pubkey)
+            self._pending_transactions = 0
+            self._pending_fees = 0
+            self._template_time = time.monotonic()
+
+            self._cur_work_id += 1
+            self._cur_block = block
+            header = hexlify(block.get_partial_header()).decode()
+            for i, pipe in enumerate(self._work_pipes):
+                send_message(pipe, {
+                    'work_id': self._cur_work_id,
+                    'header': header,
+                    'difficulty': block.difficulty,
+                    'first_nonce': i,
+                    'nonce_step': self.worker_count,
+                })
 
     def _chain_changed(self):
         if not self._stopped and self._started:
+            with self._miner_cond:
+                changed = time.monotonic()
+                self.start_mining()
+                self._chain_change_work_id = self._cur_work_id
+                self._chain_change_time = changed
+                self._chain_change_acks = set()
+
+    def _template_outdated(self) -> bool:
+        """ Returns whether the current block should be rebuilt because of new transactions. """
+        if not self._pending_transactions:
+            return False
+        if self.template_fee_delta is not None and self._pending_fees >= self.template_fee_delta:
+            return True
+        return self.template_interval is not None and \
+                time.monotonic() - self._template_time >= self.template_interval
+
+    def _transactions_changed(self, transaction: 'Transaction'):
+        if self._stopped or not self._started:
+            return
+        if self.template_fee_delta is None and self.template_interval is None:
+            return
+
+        entry = self.chainbuilder.unconfirmed_transactions.get_entry(transaction.get_hash())
+        if entry is None:
+            return
+        self._pending_transactions += 1
+        # transactions spending unconfirmed coins cannot be part of the next block anyway
+        if not entry.parents:
+            self._pending_fees += entry.fee
+        if self._template_outdated():
             self.start_mining()
 
-    def _stop_mining_for_now(self):
-        for pid in self._cur_miner_pids:
-            try:
-                os.kill(pid, signal.SIGKILL)
-            except ProcessLookupError:
-                pass
-        self._cur_miner_pids = []
+    def _rebuild_outdated_template(self):
+        """ Rebuilds the current block if it is outdated. Needs to be called in the protocol's main thread. """
+        if not self._stopped and self._started and self._template_outdated():
+            self.start_mining()
 
     def shutdown(self):
         """ Stop all mining. """
-        self._stopped = True
         with self._miner_cond:
-            self._stop_mining_for_now()
-            self._miner_cond.notify()
+            self._stopped = True
+            self._cur_block = None
+            for pipe in self._work_pipes:
+                os.close(pipe)
+            self._work_pipes = []
+            for pid in self._worker_pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            self._worker_pids = []
         self.chainbuilder.chain_change_handlers.remove(self._chain_changed)
+        self.chainbuilder.transaction_change_handlers.remove(self._transactions_changed)
 
 from .protocol import Protocol
 from .chainbuilder import ChainBuilder
 from .crypto import Signing
+from .transaction import Transaction
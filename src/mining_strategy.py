@@ -1,35 +1,76 @@
 """ Defines the contents of newly mined blocks. """
 
-from typing import List
+import json
+from typing import List, Optional
 
 from .block import Block
 from .transaction import Transaction, TransactionTarget
+from .signature_verification import verify_signatures
 
-__all__ = ['create_block']
+__all__ = ['create_block', 'transaction_size']
+
+def transaction_size(transaction: 'Transaction') -> int:
+    """ Returns the size of the serialized representation of `transaction` in bytes. """
+    return len(json.dumps(transaction.to_json_compatible()))
 
 def create_block(blockchain: 'Blockchain', unconfirmed_transactions: 'List[Transaction]',
-                 reward_pubkey: 'Signing') -> 'Block':
+                 reward_pubkey: 'Signing', max_size: Optional[int]=None) -> 'Block':
     """
     Creates a new block that can be mined.
 
+    The transactions are chosen by their fee per byte of their serialized representation, starting
+    with the most profitable one. A transaction conflicting with a more profitable one (by spending
+    the same coin) is left out, as is every transaction that spends coins not confirmed by
+    `blockchain`.
+
     :param blockchain: The blockchain on top of which the new block should fit.
     :param unconfirmed_transactions: The transactions that should be considered for inclusion in
                                      this block.
     :param reward_pubkey: The key that should receive block rewards.
+    :param max_size: The maximum total size of the chosen transactions (without the block reward
+                     transaction), as computed by :func:`transaction_size`. Defaults to no limit.
     """
-    transactions = set()
+    # all signatures are checked in one batch, so that they can be verified in parallel
+    candidates = []
+    signature_checks = []
     for t in unconfirmed_transactions:
-        if t.verify(blockchain, transactions):
-            # TODO: choose most profitable of conflicting transactions
-            transactions.add(t)
+        if not t.inputs or not t.verify(blockchain, set(), check_signatures=False):
+            continue
+        checks = t.get_signature_checks(blockchain)
+        if checks is None:
+            continue
+        candidates.append((t, len(signature_checks), len(checks)))
+        signature_checks.extend(checks)
+    signatures_valid = verify_signatures(signature_checks)
+
+    ranked = []
+    for t, first_check, check_count in candidates:
+        if not all(signatures_valid[first_check:first_check + check_count]):
+            continue
+        fee = t.get_transaction_fee(blockchain)
+        size = transaction_size(t)
+        ranked.append((-fee / size, t.get_hash(), fee, size, t))
+    ranked.sort(key=lambda r: r[:2])
 
+    transactions = []
+    spent_coins = set()
+    total_size = 0
+    fees = 0
+    for _, _, fee, size, t in ranked:
+        if any(inp in spent_coins for inp in t.inputs):
+            continue
+        if max_size is not None and total_size + size > max_size:
+            continue
+        spent_coins.update(t.inputs)
+        transactions.append(t)
+        total_size += size
+        fees += fee
 
     reward = blockchain.compute_blockreward_next_block()
-    fees = sum(t.get_transaction_fee(blockchain) for t in transactions)
     trans = Transaction([], [TransactionTarget(reward_pubkey, reward + fees)], [], iv=blockchain.head.hash)
-    transactions.add(trans)
+    transactions.append(trans)
 
-    return Block.create(blockchain, list(transactions))
+    return Block.create(blockchain, transactions)
 
 from .blockchain import Blockchain
 from .crypto import Signing
@@ -32,7 +32,7 @@ class Persistence:
         self._store_data = None
 
         chainbuilder.chain_change_handlers.append(self.store)
-        chainbuilder.transaction_change_handlers.append(self.store)
+        chainbuilder.transaction_change_handlers.append(lambda transaction: self.store())
         self._loading = False
 
         Thread(target=self._store_thread, daemon=True).start()
@@ -1,16 +1,59 @@
 """ Implementation and verification of the proof of work. """
 
 from datetime import timedelta
+from struct import pack
 from typing import Optional
 
 from .crypto import MAX_HASH
 
-__all__ = ['verify_proof_of_work', 'GENESIS_DIFFICULTY', 'ProofOfWork']
+__all__ = ['verify_proof_of_work', 'proof_of_work_target', 'search_nonce', 'GENESIS_DIFFICULTY']
 
 def verify_proof_of_work(block: 'Block'):
     """ Verify the proof of work on a block. """
     return int.from_bytes(block.hash, byteorder='little', signed=False) > (MAX_HASH - MAX_HASH // block.difficulty)
 
+def proof_of_work_target(difficulty: int) -> bytes:
+    """
+    Returns the value block hashes need to be larger than for a certain difficulty, as a big-endian
+    bytes value (i.e. in the reversed byte order of a hash).
+    """
+    return (MAX_HASH - MAX_HASH // difficulty).to_bytes(64, 'big')
+
+def search_nonce(partial_hasher, target: bytes, first_nonce: int, nonce_step: int,
+                 count: int) -> Optional[int]:
+    """
+    Tries `count` nonces, starting at `first_nonce` in steps of `nonce_step`, and returns the first
+    nonce that results in a block hash satisfying the proof of work, or `None`.
+
+    This computes the same hashes as `Block.finish_hash` and the same comparison as
+    `verify_proof_of_work`, but without their per-nonce overhead: all nonces with the same bit
+    length also have the same length prefix in their encoding, which is hashed only once, and the
+    hashes are compared byte-wise to the precomputed target, looking only at the most significant
+    byte unless that byte is large enough.
+
+    :param partial_hasher: The hasher returned by `Block.get_partial_hash`.
+    :param target: The target value, as returned by `proof_of_work_target`.
+    """
+    top = target[0]
+    nonce = first_nonce
+    end = first_nonce + count * nonce_step
+    while nonce < end:
+        # the encoding of Block._int_to_bytes, for all nonces with the same bit length
+        length = nonce.bit_length() + 1
+        segment_end = min(end, 1 << nonce.bit_length() if nonce else 1)
+        segment_hasher = partial_hasher.copy()
+        segment_hasher.update(pack("<Q", length))
+        copy = segment_hasher.copy
+
+        for n in range(nonce, segment_end, nonce_step):
+            h = copy()
+            h.update(n.to_bytes(length, 'little'))
+            digest = h.digest()
+            if digest[63] >= top and digest[::-1] > target:
+                return n
+        nonce += -(-(segment_end - nonce) // nonce_step) * nonce_step
+    return None
+
 GENESIS_DIFFICULTY = 1000
 """
 The difficulty of the genesis block.
@@ -23,40 +66,4 @@ DIFFICULTY_BLOCK_INTERVAL = 30
 DIFFICULTY_TARGET_TIMEDELTA = timedelta(minutes=1)
 """ The time span that it should approximately take to mine `DIFFICULTY_BLOCK_INTERVAL` blocks.  """
 
-class ProofOfWork:
-    """
-    Allows performing (and aborting) a proof of work.
-
-    :ivar stopped: A flag that is set to `True` to abort the `run` operation.
-    :vartype stopped: bool
-    :ivar block: The block on which the proof of work should be performed.
-    :param block: The block on which the proof of work should be performed.
-    :vartype block: Block
-    :ivar success: A flag indication whether the proof of work was successful or not.
-    :vartype success: bool
-    """
-
-    def __init__(self, block: 'Block'):
-        self.stopped = False
-        self.block = block
-        self.success = False
-
-    def abort(self):
-        """ Aborts execution of this proof of work. """
-        self.stopped = True
-
-    def run(self) -> 'Optional[Block]':
-        """
-        Perform the proof of work on a block, until `stopped` becomes True or the proof of
-        work was successful.
-        """
-        hasher = self.block.get_partial_hash()
-        while not self.stopped:
-            for _ in range(1000):
-                self.block.hash = self.block.finish_hash(hasher.copy())
-                if verify_proof_of_work(self.block):
-                    return self.block
-                self.block.nonce += 1
-        return None
-
 from .block import Block
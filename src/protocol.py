@@ -14,18 +14,37 @@ To make sure that the peer acting as a TCP server in a connection knows how to r
 there is a 'myport' message containing the TCP port where a peer listens for incoming connections.
 
 For other message types, you can look at the `received_*` methods of `Protocol`.
+
+All messages are handled by a single main thread. Received blocks are an exception: they are first
+parsed and checked for their proof of work and their Merkle root by a pool of pre-validation
+threads, and only blocks passing these checks are handed to the main thread, so that the
+stateless part of the block validation does not hold up other messages. The messages of each peer
+still reach the main thread in the order they were received, and at most
+`MAX_PREVALIDATION_JOBS` messages are pre-validated at the same time: the reader threads of peers
+sending more blocks have to wait.
+
+Blocks that do not build on blocks we know are not downloaded right away: only the headers of
+their ancestors are requested first ('getheaders'), so that the proof of work of a chain can be
+checked before any of its transactions are downloaded. The headers are pre-validated in the same
+way as blocks.
+
+Missing blocks are requested from one peer at a time, chosen by how fast it answered earlier
+requests and how many requests it still has to answer. Requests that are not answered in time
+are sent to another peer.
 """
 
 import json
 import socket
 import socketserver
 import logging
+import time
 from collections import namedtuple
-from threading import Thread, Lock
-from queue import Queue, PriorityQueue
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Thread, Lock, BoundedSemaphore
+from queue import Queue, PriorityQueue, Empty
 from binascii import unhexlify, hexlify
 from uuid import UUID, uuid4
-from typing import Callable, List, Optional
+from typing import Callable, List, Optional, Set
 
 from .block import GENESIS_BLOCK_HASH
 
@@ -45,6 +64,24 @@ succeed.
 SOCKET_TIMEOUT = 30
 """ The socket timeout for P2P connections. """
 
+PREVALIDATION_WORKERS = 4
+""" The number of threads that parse and pre-validate received blocks. """
+
+MAX_PREVALIDATION_JOBS = 4 * PREVALIDATION_WORKERS
+""" The maximum number of received messages that are waiting for or in pre-validation. """
+
+BLOCKS_PER_REQUEST = 100
+""" The maximum number of blocks sent in response to one 'getblocks' message. """
+
+HEADERS_PER_REQUEST = 2000
+""" The maximum number of block headers sent in response to one 'getheaders' message. """
+
+BLOCK_DOWNLOAD_TIMEOUT = 10
+""" The number of seconds after which a block request is sent to a different peer. """
+
+MAX_DOWNLOADS_PER_PEER = 4
+""" The number of block requests a peer is assigned before other peers are preferred regardless of their speed. """
+
 class PeerConnection:
     """
     Handles the low-level socket connection to one other peer.
@@ -57,6 +94,13 @@ class PeerConnection:
     :ivar proto: The Protocol instance this peer connection belongs to.
     :ivar is_connected: A boolean indicating the current connection status.
     :ivar outgoing_msgs: A queue of messages we want to send to this peer.
+    :ivar downloads: The hashes of the blocks this peer was asked for and did not send yet.
+    :vartype downloads: Set[bytes]
+    :ivar response_time: The average number of seconds this peer took to answer block requests,
+                         or `None` if it did not answer one yet.
+    :vartype response_time: Optional[float]
+    :ivar best_height: The height of the highest block this peer announced to us, or `None`.
+    :vartype best_height: Optional[int]
     """
 
     def __init__(self, peer_addr: tuple, proto: 'Protocol', sock: socket.socket=None):
@@ -68,6 +112,9 @@ class PeerConnection:
         self._sent_uuid = str(uuid4())
         self.outgoing_msgs = Queue()
         self._close_lock = Lock()
+        self.downloads = set()
+        self.response_time = None
+        self.best_height = None
 
         Thread(target=self.run, daemon=True).start()
 
@@ -196,6 +243,29 @@ class PeerConnection:
             self.proto.received(msg_type, msg_param, self)
 
 
+class BlockDownload:
+    """
+    A block request that was sent to one of our peers.
+
+    :ivar block_hash: The hash of the requested block.
+    :vartype block_hash: bytes
+    :ivar locator: The hashes of the blocks at which the peer can stop sending ancestors.
+    :vartype locator: List[bytes]
+    :ivar peer: The peer the request was sent to.
+    :vartype peer: PeerConnection
+    :ivar sent_time: The time (as returned by `time.monotonic`) when the request was sent.
+    :vartype sent_time: float
+    :ivar tried_peers: The peers this block was requested from so far.
+    :vartype tried_peers: Set[PeerConnection]
+    """
+
+    def __init__(self, block_hash: bytes, locator: List[bytes]):
+        self.block_hash = block_hash
+        self.locator = locator
+        self.peer = None
+        self.sent_time = 0.0
+        self.tried_peers = set()
+
 class SocketServer(socketserver.TCPServer):
     """ A TCP socketserver that does not close connections when the handler returns. """
 
@@ -219,14 +289,30 @@ class Protocol:
     Manages connections to our peers. Allows sending messages to them and has event handlers
     for handling messages from other peers.
 
-    :ivar block_receive_handlers: Event handlers that get called when a new block is received.
+    :ivar block_receive_handlers: Event handlers that get called when a new block is received,
+                                  together with whether it was sent by this program itself (e.g.
+                                  when loading stored blocks or after mining a block).
     :vartype block_receive_handlers: List[Callable]
+    :ivar blocks_receive_handlers: Event handlers that get called with a list of blocks received
+                                   in response to a 'getblocks' message, each one usually being
+                                   the parent of the one before.
+    :vartype blocks_receive_handlers: List[Callable]
+    :ivar headers_receive_handlers: Event handlers that get called with a list of block headers
+                                    received in response to a 'getheaders' message, each one
+                                    usually being the parent of the one before.
+    :vartype headers_receive_handlers: List[Callable]
     :ivar trans_receive_handlers: Event handlers that get called when a new transaction is received.
     :vartype trans_receive_handlers: List[Callable]
     :ivar block_request_handlers: Event handlers that get called when a block request is received.
     :vartype block_request_handlers: List[Callable]
     :ivar peers: The peers we are connected to.
     :vartype peers: List[PeerConnection]
+    :ivar _block_downloads: The block requests sent to our peers that were not answered yet, by the
+                            hash of the requested block.
+    :vartype _block_downloads: Dict[bytes, BlockDownload]
+    :ivar _prevalidation_tails: For each peer with messages in pre-validation, a future that is done
+                                once the last of its messages was handed to the main thread.
+    :vartype _prevalidation_tails: Dict[PeerConnection, Future]
     """
 
     _dummy_peer = namedtuple("DummyPeerConnection", ["peer_addr"])("self")
@@ -244,14 +330,21 @@ class Protocol:
         """
 
         self.block_receive_handlers = []
+        self.blocks_receive_handlers = []
+        self.headers_receive_handlers = []
         self.trans_receive_handlers = []
         self.block_request_handlers = []
         self._primary_block = primary_block.to_json_compatible()
+        self._primary_block_hash = primary_block.hash
         self.peers = []
         self._callback_queue = PriorityQueue()
         self._callback_counter = 0
         self._callback_counter_lock = Lock()
-
+        self._prevalidation_pool = ThreadPoolExecutor(PREVALIDATION_WORKERS)
+        self._prevalidation_slots = BoundedSemaphore(MAX_PREVALIDATION_JOBS)
+        self._prevalidation_tails = {}
+        self._prevalidation_lock = Lock()
+        self._block_downloads = {}
 
         class IncomingHandler(socketserver.BaseRequestHandler):
             """ Handler for incoming P2P connections. """
@@ -277,18 +370,19 @@ class Protocol:
 
     def broadcast_primary_block(self, block: 'Block'):
         """ Notifies all peers and local listeners of a new primary block. """
-        obj = block.to_json_compatible()
-
-        if self._primary_block == obj:
+        if self._primary_block_hash == block.hash:
             logging.debug("not broadcasting block again")
             return
 
         logging.debug("* > block %s", hexlify(block.hash))
-        self._primary_block = obj
+        self._primary_block_hash = block.hash
+        # local listeners get the block itself, it does not need to be serialized and parsed again
+        self.received('local_block', block, None, 0)
 
+        obj = block.to_json_compatible()
+        self._primary_block = obj
         for peer in self.peers:
             peer.send_msg("block", obj)
-        self.received('block', obj, None, 0)
 
     def broadcast_transaction(self, trans: 'Transaction'):
         """ Notifies all peers and local listeners of a new transaction. """
@@ -310,15 +404,92 @@ class Protocol:
         if peer is None:
             peer = self._dummy_peer
 
+        if msg_type in ('block', 'blocks', 'headers'):
+            self._prevalidation_slots.acquire()
+            with self._prevalidation_lock:
+                prev = self._prevalidation_tails.get(peer)
+                future = self._prevalidation_pool.submit(self._prevalidate_blocks, msg_type,
+                                                         msg_param, peer, prio, prev)
+                self._prevalidation_tails[peer] = future
+            future.add_done_callback(lambda f: self._prevalidation_slots.release())
+            future.add_done_callback(lambda f: self._prevalidation_done(peer, f))
+            return
+
+        with self._prevalidation_lock:
+            prev = self._prevalidation_tails.get(peer)
+            if prev is not None:
+                # the message must not overtake the messages of the same peer in pre-validation
+                future = Future()
+                def queue(_):
+                    self._queue_callback(msg_type, msg_param, peer, prio)
+                    future.set_result(None)
+                self._prevalidation_tails[peer] = future
+                future.add_done_callback(lambda f: self._prevalidation_done(peer, f))
+        if prev is not None:
+            prev.add_done_callback(queue)
+            return
+        self._queue_callback(msg_type, msg_param, peer, prio)
+
+    def _prevalidation_done(self, peer: PeerConnection, future: Future):
+        """ Forgets `future` as the last pre-validation of `peer`, unless a newer one was started. """
+        with self._prevalidation_lock:
+            if self._prevalidation_tails.get(peer) is future:
+                del self._prevalidation_tails[peer]
+
+    def _queue_callback(self, msg_type: str, msg_param, peer: PeerConnection, prio: int):
+        """ Queues a message for the main thread. """
         with self._callback_counter_lock:
             counter = self._callback_counter + 1
             self._callback_counter = counter
         self._callback_queue.put((prio, counter, msg_type, msg_param, peer))
 
+    def _prevalidate_blocks(self, msg_type: str, blocks, peer: PeerConnection, prio: int,
+                            prev: Optional[Future]):
+        """
+        Parses a received 'block', 'blocks' or 'headers' message and verifies the proof of work
+        (and, for blocks, the Merkle root) of its blocks in one of the pre-validation threads. Only
+        valid blocks are queued for the main thread, once `prev` (the handling of the message the
+        peer sent before, if it is still pending) is done.
+        """
+        try:
+            if msg_type == 'block':
+                blocks = [blocks]
+            if msg_type == 'headers':
+                blocks = [BlockHeader.from_json_compatible(h) for h in blocks[:HEADERS_PER_REQUEST]]
+            else:
+                blocks = [Block.from_json_compatible(block) for block in blocks[:BLOCKS_PER_REQUEST]]
+        except Exception:
+            logging.exception("invalid blocks from peer %s", peer.peer_addr)
+            try:
+                if peer is not self._dummy_peer:
+                    peer.close()
+            except OSError:
+                pass
+            return
+        valid = []
+        for block in blocks:
+            if not block.verify_difficulty() or (msg_type != 'headers' and not block.verify_merkle()):
+                logging.debug("%s < invalid block %s", peer.peer_addr, hexlify(block.hash))
+                continue
+            valid.append(block)
+        if prev is not None:
+            wait([prev])
+        if msg_type == 'block' and valid:
+            self._queue_callback('block', valid[0], peer, prio)
+        elif valid:
+            self._queue_callback(msg_type, valid, peer, prio)
+
     def _main_thread(self):
         """ The main loop of the one thread where all incoming events are handled. """
+        last_check = time.monotonic()
         while True:
-            _, _, msg_type, msg_param, peer = self._callback_queue.get()
+            if time.monotonic() - last_check >= 1:
+                last_check = time.monotonic()
+                self._reassign_expired_downloads()
+            try:
+                _, _, msg_type, msg_param, peer = self._callback_queue.get(timeout=1)
+            except Empty:
+                continue
             try:
                 getattr(self, 'received_' + msg_type)(msg_param, peer)
             except:
@@ -381,12 +552,88 @@ class Protocol:
                 peer.send_msg("block", block.to_json_compatible())
                 break
 
-    def received_block(self, block: dict, sender: PeerConnection):
-        """ Someone sent us a block. """
-        block = Block.from_json_compatible(block)
+    def _find_ancestors(self, request: dict, max_count: int) -> 'List[Block]':
+        """
+        Returns up to 'count' blocks (but no more than `max_count`) of a 'getblocks' or
+        'getheaders' request, starting with the block with the hash 'block_hash' and going back in
+        its chain, until we reach one of the blocks in 'locator', which the peer already knows.
+        """
+        block_hash = unhexlify(request['block_hash'])
+        locator = {unhexlify(h) for h in request['locator']}
+        count = min(int(request['count']), max_count)
+
+        blocks = []
+        while len(blocks) < count and block_hash not in locator:
+            for handler in self.block_request_handlers:
+                block = handler(block_hash)
+                if block is not None:
+                    break
+            else:
+                break
+            blocks.append(block)
+            block_hash = block.prev_block_hash
+        return blocks
+
+    def received_getblocks(self, request: dict, peer: PeerConnection):
+        """
+        We received a request for a block and its ancestors from a certain peer. We send up to
+        'count' blocks (but no more than `BLOCKS_PER_REQUEST`), starting with the block with the
+        hash 'block_hash' and going back in its chain, until we reach one of the blocks in
+        'locator', which the peer already knows.
+        """
+        logging.debug("%s < getblocks %s", peer.peer_addr, request['block_hash'])
+        blocks = self._find_ancestors(request, BLOCKS_PER_REQUEST)
+        if blocks:
+            peer.send_msg("blocks", [block.to_json_compatible() for block in blocks])
+
+    def received_getheaders(self, request: dict, peer: PeerConnection):
+        """
+        We received a request for the headers of a block and its ancestors from a certain peer. The
+        request works like a 'getblocks' request, but up to `HEADERS_PER_REQUEST` headers are sent.
+        """
+        logging.debug("%s < getheaders %s", peer.peer_addr, request['block_hash'])
+        blocks = self._find_ancestors(request, HEADERS_PER_REQUEST)
+        if blocks:
+            peer.send_msg("headers", [block.get_header().to_json_compatible() for block in blocks])
+
+    def received_block(self, block: 'Block', sender: PeerConnection):
+        """ Someone sent us a block, which was already pre-validated. """
         logging.debug("%s < block %s", sender.peer_addr, hexlify(block.hash))
+        if sender is not self._dummy_peer and (sender.best_height or 0) < block.height:
+            sender.best_height = block.height
+        self._block_download_finished(block.hash, sender)
+        for handler in self.block_receive_handlers:
+            handler(block, sender is self._dummy_peer)
+
+    def received_blocks(self, blocks: 'List[Block]', sender: PeerConnection):
+        """ Someone sent us a list of blocks we requested, which were already pre-validated. """
+        logging.debug("%s < blocks %s", sender.peer_addr, hexlify(blocks[0].hash))
+        self._block_download_finished(blocks[0].hash, sender)
+        for handler in self.blocks_receive_handlers:
+            handler(blocks)
+
+    def received_headers(self, headers: 'List[BlockHeader]', sender: PeerConnection):
+        """ Someone sent us a list of block headers we requested, which were already pre-validated. """
+        logging.debug("%s < headers %s", sender.peer_addr, hexlify(headers[0].hash))
+        for handler in self.headers_receive_handlers:
+            handler(headers)
+
+    def received_local_block(self, block: 'Block', sender: PeerConnection):
+        """ A block was broadcast by this program. """
+        if sender is not self._dummy_peer:
+            raise ValueError("local blocks cannot be received from peers")
         for handler in self.block_receive_handlers:
-            handler(block)
+            handler(block, True)
+
+    def received_local_call(self, fn: Callable[[], None], sender: PeerConnection):
+        """ A function was passed to `call_in_main_thread` by this program. """
+        if sender is not self._dummy_peer:
+            raise ValueError("local calls cannot be received from peers")
+        fn()
+
+    def call_in_main_thread(self, fn: Callable[[], None]):
+        """ Calls `fn` in the main thread, where all other events are handled. """
+        self.received('local_call', fn, None, 0)
 
     def received_transaction(self, transaction: dict, sender: PeerConnection):
         """ Someone sent us a transaction. """
@@ -404,12 +651,106 @@ class Protocol:
         """
         if not peer.is_connected:
             self.peers.remove(peer)
+            for block_hash in list(peer.downloads):
+                self._assign_block_download(self._block_downloads[block_hash])
 
-    def send_block_request(self, block_hash: bytes):
-        """ Sends a request for a block to all our peers. """
-        logging.debug("* > getblock %s", hexlify(block_hash))
-        for peer in self.peers:
-            peer.send_msg("getblock", hexlify(block_hash).decode())
+    def send_block_request(self, block_hash: bytes, locator: 'List[bytes]'=()):
+        """
+        Sends a request for a block to one of our peers. Up to `BLOCKS_PER_REQUEST` of its
+        ancestors are requested as well, stopping at the blocks in `locator`.
+
+        The request is sent to the peer that is expected to answer first: peers that announced
+        blocks to us are preferred, then peers with a short average response time and few
+        unanswered requests. If the peer does not answer within `BLOCK_DOWNLOAD_TIMEOUT` seconds
+        (or this method is called for the same block again), the request is sent to another peer.
+        """
+        download = self._block_downloads.get(block_hash)
+        if download is None:
+            download = BlockDownload(block_hash, list(locator))
+            self._block_downloads[block_hash] = download
+        else:
+            download.locator = list(locator)
+        self._assign_block_download(download, True)
+
+    def send_headers_request(self, block_hash: bytes, locator: 'List[bytes]'=()):
+        """
+        Sends a request for the header of a block and the headers of up to `HEADERS_PER_REQUEST`
+        of its ancestors, stopping at the blocks in `locator`, to the peer that is expected to
+        answer first. Unanswered header requests are not retried.
+        """
+        peers = [p for p in self.peers if p.is_connected]
+        if not peers:
+            return
+        peer = min(peers, key=self._expected_delay)
+        logging.debug("%s > getheaders %s", peer.peer_addr, hexlify(block_hash))
+        peer.send_msg("getheaders", {
+            'block_hash': hexlify(block_hash).decode(),
+            'locator': [hexlify(h).decode() for h in locator],
+            'count': HEADERS_PER_REQUEST,
+        })
+
+    @staticmethod
+    def _expected_delay(peer: PeerConnection):
+        """ The sort key of peers to send requests to, the peer expected to answer first being the smallest. """
+        delay = peer.response_time if peer.response_time is not None else 1.0
+        return (peer.best_height is None, len(peer.downloads) >= MAX_DOWNLOADS_PER_PEER,
+                delay * (len(peer.downloads) + 1))
+
+    def _assign_block_download(self, download: BlockDownload, start_over: bool=False):
+        """
+        Sends the block request `download` to a peer it was not sent to yet. If there is no such
+        peer, the request is given up, unless `start_over` is set, in which case all peers are
+        considered again.
+        """
+        if download.peer is not None:
+            download.peer.downloads.discard(download.block_hash)
+
+        peers = [p for p in self.peers if p.is_connected]
+        untried = [p for p in peers if p not in download.tried_peers]
+        if not untried and start_over:
+            download.tried_peers.clear()
+            untried = peers
+        if not untried:
+            del self._block_downloads[download.block_hash]
+            return
 
-from .block import Block
+        peer = min(untried, key=self._expected_delay)
+
+        download.peer = peer
+        download.sent_time = time.monotonic()
+        download.tried_peers.add(peer)
+        peer.downloads.add(download.block_hash)
+        logging.debug("%s > getblocks %s", peer.peer_addr, hexlify(download.block_hash))
+        peer.send_msg("getblocks", {
+            'block_hash': hexlify(download.block_hash).decode(),
+            'locator': [hexlify(h).decode() for h in download.locator],
+            'count': BLOCKS_PER_REQUEST,
+        })
+
+    def _block_download_finished(self, block_hash: bytes, sender: PeerConnection):
+        """ Marks the request for the block with hash `block_hash` as answered by `sender`. """
+        download = self._block_downloads.pop(block_hash, None)
+        if download is None:
+            return
+        download.peer.downloads.discard(block_hash)
+        if download.peer is sender:
+            delay = time.monotonic() - download.sent_time
+            if sender.response_time is None:
+                sender.response_time = delay
+            else:
+                sender.response_time = 0.8 * sender.response_time + 0.2 * delay
+
+    def _reassign_expired_downloads(self):
+        """ Sends block requests that were not answered within `BLOCK_DOWNLOAD_TIMEOUT` seconds to other peers. """
+        now = time.monotonic()
+        for download in list(self._block_downloads.values()):
+            if now - download.sent_time < BLOCK_DOWNLOAD_TIMEOUT:
+                continue
+            peer = download.peer
+            # the peer counts as slow until it answers a request again
+            peer.response_time = max(peer.response_time or 0, BLOCK_DOWNLOAD_TIMEOUT)
+            logging.debug("%s did not send block %s in time", peer.peer_addr, hexlify(download.block_hash))
+            self._assign_block_download(download)
+
+from .block import Block, BlockHeader
 from .transaction import Transaction
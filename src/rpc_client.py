@@ -1,7 +1,7 @@
 """ The RPC functionality used by the wallet to talk to the miner application. """
 
 import json
-from typing import List, Tuple, Iterator
+from typing import List, Tuple, Iterator, Optional
 
 import requests
 
@@ -28,6 +28,15 @@ class RPCClient:
         resp.raise_for_status()
         return [tuple(peer) for peer in resp.json()]
 
+    def mining_info(self) -> Optional[dict]:
+        """
+        Returns the mining statistics of the miner (see :any:`Miner.mining_info`), or `None` if it
+        does not mine.
+        """
+        resp = self.sess.get(self.url + 'mining-info')
+        resp.raise_for_status()
+        return resp.json()
+
     def get_transactions(self, pubkey: Signing) -> List[Transaction]:
         """ Returns all transactions involving a certain public key. """
         resp = self.sess.post(self.url + 'transactions', data=pubkey.as_bytes(),
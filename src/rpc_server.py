@@ -1,15 +1,15 @@
 """ The RPC functionality the miner provides for the wallet. """
 
 import json
+from typing import Optional
 
 import flask
 
 from .chainbuilder import ChainBuilder
 from .persistence import Persistence
 from .crypto import Signing
-from .transaction import TransactionInput
 
-def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence):
+def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence, miner: 'Optional[Miner]'=None):
     """ Runs the RPC server (forever). """
 
     app = flask.Flask(__name__)
@@ -19,6 +19,11 @@ def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence):
         """ Returns the connected peers. """
         return json.dumps([list(peer.peer_addr)[:2] for peer in chainbuilder.protocol.peers if peer.is_connected])
 
+    @app.route("/mining-info", methods=['GET'])
+    def get_mining_info():
+        """ Returns the mining statistics, or `null` if this node does not mine. """
+        return json.dumps(miner.mining_info() if miner is not None else None)
+
     @app.route("/new-transaction", methods=['PUT'])
     def send_transaction():
         """ Sends a transaction to the network, and uses it for mining. """
@@ -28,13 +33,9 @@ def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence):
     @app.route("/show-balance", methods=['POST'])
     def show_balance():
         """ Returns the balance of a number of public keys. """
-        pubkeys = {Signing.from_json_compatible(pk): i for (i, pk) in enumerate(flask.request.json)}
-        amounts = [0 for _ in pubkeys.values()]
-        for output in chainbuilder.primary_block_chain.unspent_coins.values():
-            if output.recipient_pk in pubkeys:
-                amounts[pubkeys[output.recipient_pk]] += output.amount
-
-        return json.dumps(amounts)
+        pubkeys = [Signing.from_json_compatible(pk) for pk in flask.request.json]
+        unspent_coins = chainbuilder.primary_block_chain.unspent_coins
+        return json.dumps([unspent_coins.get_balance(pk) for pk in pubkeys])
 
     @app.route("/build-transaction", methods=['POST'])
     def build_transaction():
@@ -50,13 +51,16 @@ def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence):
 
         inputs = []
         used_keys = []
-        for (inp, output) in chainbuilder.primary_block_chain.unspent_coins.items():
-            if output.recipient_pk in sender_pks:
+        unspent_coins = chainbuilder.primary_block_chain.unspent_coins
+        for pk, key_idx in sender_pks.items():
+            for (inp, output) in unspent_coins.get_coins_by_recipient(pk):
                 amount -= output.amount
                 inputs.append(inp.to_json_compatible())
-                used_keys.append(sender_pks[output.recipient_pk])
+                used_keys.append(key_idx)
                 if amount <= 0:
                     break
+            if amount <= 0:
+                break
 
         if amount > 0:
             inputs = []
@@ -73,21 +77,7 @@ def rpc_server(port: int, chainbuilder: ChainBuilder, persist: Persistence):
     def get_transactions_for_key():
         """ Returns all transactions involving a certain public key. """
         key = Signing(flask.request.data)
-        transactions = set()
-        outputs = set()
-        chain = chainbuilder.primary_block_chain
-        for b in chain.blocks:
-            for t in b.transactions:
-                for i, target in enumerate(t.targets):
-                    if target.recipient_pk == key:
-                        transactions.add(t)
-                        outputs.add(TransactionInput(t.get_hash(), i))
-        for b in chain.blocks:
-            for t in b.transactions:
-                for inp in t.inputs:
-                    if inp in outputs:
-                        transactions.add(t)
-
-        return json.dumps([t.to_json_compatible() for t in transactions])
+        history = chainbuilder.primary_block_chain.get_transaction_history(key)
+        return json.dumps([t.to_json_compatible() for _, t in history])
 
     app.run(port=port)
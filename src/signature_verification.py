@@ -0,0 +1,94 @@
+"""
+Verification of many signatures at once, spread over a pool of worker processes.
+
+Signature checks are the most expensive part of validating blocks and transactions. Instead of
+checking them one after another in the protocol's main thread, all signatures of a block are
+collected and verified in one batch by :func:`verify_signatures`. Large batches are split into
+one chunk per worker process; small batches are verified in the calling process, as the
+communication with the workers would take longer than the verification itself.
+
+Most transactions are verified at least twice: once when they are received and once more as part
+of a block. Therefore, successfully verified signatures are remembered in a bounded cache, from
+which the least recently used entries are evicted.
+"""
+
+import os
+import multiprocessing
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Tuple
+
+__all__ = ['verify_signatures', 'set_worker_count', 'MIN_PARALLEL_SIGNATURES', 'SIGNATURE_CACHE_SIZE']
+
+MIN_PARALLEL_SIGNATURES = 16
+""" The minimum number of signatures in a batch for which the worker processes are used. """
+
+SIGNATURE_CACHE_SIZE = 50000
+""" The maximum number of successful signature checks that are remembered. """
+
+_worker_count = os.cpu_count() or 1
+_pool = None
+_pool_lock = Lock()
+
+_cache = OrderedDict()
+_cache_lock = Lock()
+
+def set_worker_count(count: int):
+    """
+    Sets the number of worker processes used to verify signatures. Defaults to the number of
+    CPUs. With a `count` of 1, all signatures are verified in the calling process.
+    """
+    global _worker_count, _pool
+    if count < 1:
+        raise ValueError("the number of workers must be positive")
+    with _pool_lock:
+        _worker_count = count
+        if _pool is not None:
+            _pool.terminate()
+            _pool = None
+
+def _get_pool() -> 'multiprocessing.pool.Pool':
+    """ Returns the pool of worker processes, starting it if necessary. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(_worker_count)
+        return _pool
+
+def _verify_chunk(checks: 'List[Tuple[Signing, bytes, bytes]]') -> List[bool]:
+    """ Verifies the signatures in `checks` in this process. """
+    return [pubkey.verify_sign(hashed_value, signature) for pubkey, hashed_value, signature in checks]
+
+def verify_signatures(checks: 'List[Tuple[Signing, bytes, bytes]]') -> List[bool]:
+    """
+    Verifies a batch of signatures.
+
+    :param checks: Tuples of the public key, the signed hash value and the signature to verify.
+    :return: A bool for each tuple in `checks`, indicating whether the signature is valid.
+    """
+    with _cache_lock:
+        uncached = []
+        for check in checks:
+            if check in _cache:
+                _cache.move_to_end(check)
+            else:
+                uncached.append(check)
+
+    if _worker_count == 1 or len(uncached) < MIN_PARALLEL_SIGNATURES:
+        results = _verify_chunk(uncached)
+    else:
+        chunk_size = -(-len(uncached) // _worker_count)
+        chunks = [uncached[i:i + chunk_size] for i in range(0, len(uncached), chunk_size)]
+        results = [valid for chunk in _get_pool().map(_verify_chunk, chunks) for valid in chunk]
+
+    results = dict(zip(uncached, results))
+    with _cache_lock:
+        for check, valid in results.items():
+            if valid:
+                _cache[check] = True
+        while len(_cache) > SIGNATURE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return [results.get(check, True) for check in checks]
+
+from .crypto import Signing
@@ -3,7 +3,7 @@
 import logging
 from collections import namedtuple
 from binascii import hexlify, unhexlify
-from typing import List, Set
+from typing import List, Mapping, Set, Optional, Tuple
 
 from .crypto import get_hasher, Signing
 
@@ -137,24 +137,39 @@ class Transaction:
         for private_key in private_keys:
             self.signatures.append(private_key.sign(self.get_hash()))
 
-    def _verify_signatures(self, chain: 'Blockchain'):
-        """ Verifies that all inputs are signed and the signatures are valid. """
+    def get_signature_checks(self, chain: 'Blockchain', unconfirmed: 'Optional[Mapping[bytes, Transaction]]'=None) \
+            -> 'Optional[List[Tuple[Signing, bytes, bytes]]]':
+        """
+        Returns the signature checks needed to verify that all inputs are signed, as tuples
+        of public key, signed hash value and signature for :func:`verify_signatures`. Returns
+        `None` if the signatures cannot be valid at all.
+
+        :param unconfirmed: Unconfirmed transactions by their hash, whose coins may be spent as
+                            well as the unspent coins of `chain`.
+        """
         if len(self.signatures) != len(self.inputs):
             logging.warning("wrong number of signatures")
-            return False
+            return None
+
+        checks = []
+        for (sig, inp) in zip(self.signatures, self.inputs):
+            outp = chain.unspent_coins.get(inp)
+            if outp is None and unconfirmed is not None:
+                parent = unconfirmed.get(inp.transaction_hash)
+                if parent is not None and inp.output_idx < len(parent.targets):
+                    outp = parent.targets[inp.output_idx]
+            if outp is None:
+                logging.warning("Referenced transaction input could not be found.")
+                return None
+            checks.append((outp.recipient_pk, self.get_hash(), sig))
+        return checks
 
-        for (s, i) in zip(self.signatures, self.inputs):
-            if not self._verify_single_sig(s, i, chain):
-                return False
-        return True
-
-    def _verify_single_sig(self, sig: bytes, inp: TransactionInput, chain: 'Blockchain') -> bool:
-        """ Verifies the signature on a single input. """
-        outp = chain.unspent_coins.get(inp)
-        if outp is None:
-            logging.warning("Referenced transaction input could not be found.")
+    def _verify_signatures(self, chain: 'Blockchain'):
+        """ Verifies that all inputs are signed and the signatures are valid. """
+        checks = self.get_signature_checks(chain)
+        if checks is None:
             return False
-        if not outp.recipient_pk.verify_sign(self.get_hash(), sig):
+        if not all(verify_signatures(checks)):
             logging.warning("Transaction signature does not verify.")
             return False
         return True
@@ -197,10 +212,18 @@ class Transaction:
             return False
         return True
 
-    def verify(self, chain: 'Blockchain', other_trans: 'Set[Transaction]') -> bool:
-        """ Verifies that this transaction is completely valid. """
+    def verify(self, chain: 'Blockchain', other_trans: 'Set[Transaction]',
+               check_signatures: bool=True) -> bool:
+        """
+        Verifies that this transaction is completely valid.
+
+        :param check_signatures: Whether the signatures should be verified. If this is `False`, the
+                                 caller needs to verify the checks from `get_signature_checks`.
+        """
         return self._verify_single_spend(chain, other_trans) and \
-               self._verify_signatures(chain) and self._verify_amounts(chain)
+               (not check_signatures or self._verify_signatures(chain)) and \
+               self._verify_amounts(chain)
 
 from .blockchain import Blockchain
 from .block import Block
+from .signature_verification import verify_signatures
@@ -0,0 +1,192 @@
+""" A persistent set of unspent coins that can be shared between block chains. """
+
+from collections.abc import Mapping
+from typing import Dict, Optional, Iterator, Tuple
+
+__all__ = ['UnspentCoins']
+
+class UnspentCoins(Mapping):
+    """
+    An immutable mapping from (allowed/available) transaction inputs to the transaction output
+    that created this coin. Additionally, the coins and the balance of each recipient public key
+    can be looked up efficiently.
+
+    Instead of copying the complete mapping for every block, an instance only stores the changes
+    (a delta layer) relative to a parent instance. New layers are merged with their parent like in a
+    binary counter: a layer is merged as soon as its parent does not describe more blocks than the
+    layer itself. That way, a set describing `N` blocks never has more than `log_2(N) + 1` layers,
+    and each coin is copied `O(log N)` times in total. Since layers are never modified once they
+    are created, block chains with a common history also share the layers describing it.
+
+    :ivar _parent: The layer below this one, or `None` for the bottom layer.
+    :vartype _parent: Optional[UnspentCoins]
+    :ivar _delta: The changes in this layer: created coins are mapped to the transaction target,
+                  spent coins are mapped to `None`. The bottom layer only contains created coins.
+    :vartype _delta: Dict[TransactionInput, Optional[TransactionTarget]]
+    :ivar _by_recipient: The changes in `_delta`, grouped by the public key of the recipient.
+    :vartype _by_recipient: Dict[Signing, Dict[TransactionInput, Optional[TransactionTarget]]]
+    :ivar _balances: The change of the balance of each public key in this layer.
+    :vartype _balances: Dict[Signing, int]
+    :ivar _block_count: The number of blocks whose changes were merged into this layer.
+    :vartype _block_count: int
+    :ivar _len: The number of unspent coins in this set.
+    :vartype _len: int
+    """
+
+    def __init__(self, parent: 'Optional[UnspentCoins]'=None, delta: dict=None,
+                 by_recipient: dict=None, balances: dict=None, block_count: int=0, length: int=0):
+        self._parent = parent
+        self._delta = delta if delta is not None else {}
+        self._by_recipient = by_recipient if by_recipient is not None else {}
+        self._balances = balances if balances is not None else {}
+        self._block_count = block_count
+        self._len = length
+
+    def __getitem__(self, inp: 'TransactionInput') -> 'TransactionTarget':
+        layer = self
+        while layer is not None:
+            if inp in layer._delta:
+                outp = layer._delta[inp]
+                if outp is None:
+                    break
+                return outp
+            layer = layer._parent
+        raise KeyError(inp)
+
+    def __iter__(self):
+        return (inp for inp, _ in self._iter_layers(lambda layer: layer._delta))
+
+    def __len__(self):
+        return self._len
+
+    def _iter_layers(self, get_delta) -> 'Iterator[Tuple[TransactionInput, TransactionTarget]]':
+        """ Merges the deltas returned by `get_delta` for all layers, and yields the unspent coins. """
+        seen = set()
+        layer = self
+        while layer is not None:
+            delta = get_delta(layer)
+            if delta:
+                for inp, outp in delta.items():
+                    if inp in seen:
+                        continue
+                    if layer._parent is not None:
+                        seen.add(inp)
+                    if outp is not None:
+                        yield inp, outp
+            layer = layer._parent
+
+    def get_coins_by_recipient(self, recipient_pk: 'Signing') -> 'Iterator[Tuple[TransactionInput, TransactionTarget]]':
+        """ Returns the unspent coins that were sent to `recipient_pk`. """
+        return self._iter_layers(lambda layer: layer._by_recipient.get(recipient_pk))
+
+    def get_balance(self, recipient_pk: 'Signing') -> int:
+        """ Returns the total amount of all unspent coins that were sent to `recipient_pk`. """
+        balance = 0
+        layer = self
+        while layer is not None:
+            balance += layer._balances.get(recipient_pk, 0)
+            layer = layer._parent
+        return balance
+
+    def apply(self, delta: 'Dict[TransactionInput, Optional[TransactionTarget]]',
+              block_count: int=1) -> 'UnspentCoins':
+        """
+        Returns a new set of unspent coins with the changes in `delta` applied on top of this one.
+
+        :param delta: The created coins, mapped to their transaction target, and the spent coins,
+                      mapped to `None`.
+        :param block_count: The number of blocks described by `delta`.
+        """
+        coins = self._new_layer(delta, block_count)
+        while coins._parent is not None and coins._parent._block_count <= coins._block_count:
+            coins = coins._merge_with_parent()
+        return coins
+
+    def revert(self, delta: 'Dict[TransactionInput, Optional[TransactionTarget]]',
+               block_count: int) -> 'UnspentCoins':
+        """
+        Returns a new set of unspent coins with the changes in `delta`, which undo the last
+        `block_count` blocks described by this layer, merged into this layer. Unlike with `apply`,
+        no layer describing the undone blocks stays reachable from the result.
+
+        :param delta: The coins created by the undone blocks, mapped to `None`, and the coins spent
+                      by them, mapped to their transaction target.
+        :param block_count: The number of blocks undone by `delta`. Must be smaller than the
+                            number of blocks described by this layer.
+        """
+        assert 0 < block_count < self._block_count
+        # the coins created by the undone blocks did not exist before them
+        return self._new_layer(delta, -block_count)._merge_with_parent(True)
+
+    def get_layer(self, block_count: int) -> 'Tuple[UnspentCoins, int]':
+        """
+        Returns the lowest of the layers of this set (including the layers below it) that
+        describes at least the first `block_count` blocks, together with the number of blocks it
+        describes. An empty set is returned for zero blocks.
+        """
+        described = sum(layer._block_count for layer in self._layers())
+        for layer in self._layers():
+            if described - layer._block_count < block_count:
+                return layer, described
+            described -= layer._block_count
+        return UnspentCoins(), 0
+
+    def _layers(self) -> 'Iterator[UnspentCoins]':
+        """ Yields this layer and all layers below it, top-most first. """
+        layer = self
+        while layer is not None:
+            yield layer
+            layer = layer._parent
+
+    def _new_layer(self, delta: 'Dict[TransactionInput, Optional[TransactionTarget]]',
+                   block_count: int) -> 'UnspentCoins':
+        """ Returns a new layer on top of this one, containing the changes in `delta`. """
+        length = self._len
+        by_recipient = {}
+        balances = {}
+        for inp, outp in delta.items():
+            old_outp = self.get(inp)
+            if old_outp is not None:
+                length -= 1
+                by_recipient.setdefault(old_outp.recipient_pk, {})[inp] = None
+                balances[old_outp.recipient_pk] = balances.get(old_outp.recipient_pk, 0) - old_outp.amount
+            if outp is not None:
+                length += 1
+                by_recipient.setdefault(outp.recipient_pk, {})[inp] = outp
+                balances[outp.recipient_pk] = balances.get(outp.recipient_pk, 0) + outp.amount
+
+        return UnspentCoins(self, dict(delta), by_recipient, balances, block_count, length)
+
+    def _merge_with_parent(self, forget_spent: bool=False) -> 'UnspentCoins':
+        """
+        Returns a new layer containing the changes of both this layer and its parent.
+
+        :param forget_spent: Whether the coins spent in this layer did not exist below the parent
+                             layer, so that they can be removed instead of being marked as spent.
+        """
+        parent = self._parent
+
+        def merge(parent_delta, delta):
+            if parent._parent is not None and not forget_spent:
+                merged = parent_delta.copy()
+                merged.update(delta)
+                return merged
+            # spent coins need not be remembered in the bottom layer, or if they never existed
+            merged = {inp: outp for inp, outp in parent_delta.items() if delta.get(inp, outp) is not None}
+            merged.update((inp, outp) for inp, outp in delta.items() if outp is not None)
+            return merged
+
+        by_recipient = parent._by_recipient.copy()
+        for recipient_pk, delta in self._by_recipient.items():
+            by_recipient[recipient_pk] = merge(by_recipient.get(recipient_pk, {}), delta)
+            if not by_recipient[recipient_pk]:
+                del by_recipient[recipient_pk]
+
+        balances = parent._balances.copy()
+        for recipient_pk, amount in self._balances.items():
+            balances[recipient_pk] = balances.get(recipient_pk, 0) + amount
+            if not balances[recipient_pk]:
+                del balances[recipient_pk]
+
+        return UnspentCoins(parent._parent, merge(parent._delta, self._delta), by_recipient,
+                            balances, parent._block_count + self._block_count, self._len)
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from .utils import *
+from src.block_cache import BlockCache
+
+def test_block_cache_spill():
+    chain = Blockchain()
+    blocks = [Block.create(chain, [], chain.head.time + timedelta(seconds=i + 1)) for i in range(5)]
+
+    pinned = {blocks[0].hash}
+    cache = BlockCache(2, is_pinned=lambda h: h in pinned)
+    for block in blocks:
+        cache[block.hash] = block
+
+    # the pinned block stays in memory, the least recently used others were moved to disk
+    assert set(cache._blocks) == {blocks[0].hash, blocks[4].hash}
+    assert len(cache) == 5 and set(cache) == {b.hash for b in blocks}
+    assert blocks[1].hash in cache and b"unknown" not in cache
+
+    loaded = cache[blocks[1].hash]
+    assert loaded is not blocks[1]
+    assert loaded.to_json_compatible() == blocks[1].to_json_compatible()
+    assert set(cache._blocks) == {blocks[0].hash, blocks[1].hash}
+    assert cache.get(b"unknown") is None
@@ -0,0 +1,161 @@
+from datetime import timedelta
+
+from .utils import *
+from .test_verifications import block_test
+from src.chainbuilder import ChainBuilder
+
+def receive_blocks(builder, chain, transactions):
+    """ Mines a block for each list in `transactions` on top of `chain` and sends them to `builder`. """
+    for trans in transactions:
+        block = Block.create(chain, trans)
+        chain = chain.try_append(block)
+        assert chain is not None
+        builder.new_block_received(block)
+    return chain
+
+@block_test()
+def test_restore_transactions(chain):
+    builder = ChainBuilder(DummyProtocol())
+    key = Signing.generate_private_key()
+    reward_trans = Transaction([], [TransactionTarget(key, chain.compute_blockreward_next_block())])
+    chain = receive_blocks(builder, chain, [[reward_trans]])
+
+    trans1 = new_trans(reward_trans, fee=1)
+    trans2 = new_trans(trans1)
+    receive_blocks(builder, chain, [[trans1], [trans2]])
+    assert builder.primary_block_chain.head.transactions == [trans2]
+    assert len(builder.unconfirmed_transactions) == 0
+
+    # a longer fork without these transactions makes them unconfirmed again
+    fork_reward = Transaction([], [TransactionTarget(key, 1)], iv=b"fork")
+    fork = receive_blocks(builder, chain, [[fork_reward], [], []])
+    assert builder.primary_block_chain.head.hash == fork.head.hash
+    assert set(builder.unconfirmed_transactions) == {trans1.get_hash(), trans2.get_hash()}
+    assert builder.unconfirmed_transactions.get_entry(trans2.get_hash()).parents == {trans1.get_hash()}
+
+@block_test()
+def test_restore_transactions_with_unconfirmed_child(chain):
+    builder = ChainBuilder(DummyProtocol())
+    key = Signing.generate_private_key()
+    reward_trans = Transaction([], [TransactionTarget(key, chain.compute_blockreward_next_block())])
+    chain = receive_blocks(builder, chain, [[reward_trans]])
+
+    parent = new_trans(reward_trans, fee=1)
+    receive_blocks(builder, chain, [[parent]])
+    child = new_trans(parent)
+    builder.new_transaction_received(child)
+    assert set(builder.unconfirmed_transactions) == {child.get_hash()}
+
+    # the child, which was never part of a block, stays valid once its parent is rolled back
+    fork_reward = Transaction([], [TransactionTarget(key, 1)], iv=b"fork")
+    fork = receive_blocks(builder, chain, [[fork_reward], []])
+    assert builder.primary_block_chain.head.hash == fork.head.hash
+    assert set(builder.unconfirmed_transactions) == {parent.get_hash(), child.get_hash()}
+    assert builder.unconfirmed_transactions.get_entry(child.get_hash()).parents == {parent.get_hash()}
+    assert builder.unconfirmed_transactions.get_entry(parent.get_hash()).children == {child.get_hash()}
+
+@block_test()
+def test_batched_block_download(chain):
+    proto = DummyProtocol()
+    builder = ChainBuilder(proto)
+    blocks = []
+    for i in range(5):
+        block = Block.create(chain, [])
+        chain = chain.try_append(block)
+        blocks.append(block)
+
+    # the head is announced, the headers of its ancestors are requested up to the genesis block
+    builder.new_block_received(blocks[-1])
+    assert proto.headers_requests == [(blocks[-2].hash, {GENESIS_BLOCK_HASH})]
+    assert proto.block_requests == []
+
+    # once the headers are verified, the blocks themselves are requested
+    builder.new_headers_received([b.get_header() for b in blocks[-2::-1]])
+    assert proto.block_requests == [(blocks[-2].hash, {GENESIS_BLOCK_HASH})]
+
+    # the ancestors arrive in one batch, so no more requests are necessary
+    builder.new_blocks_received(blocks[-2::-1])
+    assert len(proto.block_requests) == 1
+    assert builder.primary_block_chain.head.hash == blocks[-1].hash
+
+@block_test()
+def test_headers_first(chain):
+    proto = DummyProtocol()
+    builder = ChainBuilder(proto)
+    fork = chain
+    chain = receive_blocks(builder, chain, [[]] * 4)
+    assert builder.primary_block_chain.head.hash == chain.head.hash
+
+    # a fork that is not higher than the primary block chain is not downloaded
+    fork_blocks = []
+    for i in range(3):
+        block = Block.create(fork, [], fork.head.time + timedelta(seconds=1))
+        fork = fork.try_append(block)
+        fork_blocks.append(block)
+    builder.new_block_received(fork_blocks[-1])
+    assert proto.headers_requests == [] and proto.block_requests == []
+    assert fork_blocks[-1].hash not in builder.block_cache
+
+    # the headers of a longer fork arrive in two parts, the newer ones first
+    for i in range(2):
+        block = Block.create(fork, [], fork.head.time + timedelta(seconds=1))
+        fork = fork.try_append(block)
+        fork_blocks.append(block)
+    builder.new_block_received(fork_blocks[-1])
+    assert proto.headers_requests[-1][0] == fork_blocks[-2].hash
+    builder.new_headers_received([b.get_header() for b in fork_blocks[-2:1:-1]])
+    assert proto.headers_requests[-1][0] == fork_blocks[1].hash
+    assert proto.block_requests == []
+
+    # invalid headers do not lead to block downloads
+    forged = fork_blocks[1].get_header().to_json_compatible()
+    forged['height'] += 1
+    builder.new_headers_received([BlockHeader.from_json_compatible(forged)])
+    assert proto.block_requests == []
+
+    builder.new_headers_received([b.get_header() for b in fork_blocks[1::-1]])
+    assert [h for h, _ in proto.block_requests] == [fork_blocks[-2].hash]
+    builder.new_blocks_received(fork_blocks[-2::-1])
+    assert builder.primary_block_chain.head.hash == fork.head.hash
+
+    # only the hashes of blocks of the new primary block chain are kept as checkpoints
+    assert GENESIS_BLOCK_HASH in builder._blockchain_checkpoints
+    assert all(fork.get_block_by_hash(h) is not None for h in builder._blockchain_checkpoints)
+
+@block_test()
+def test_load_stored_blocks(chain):
+    proto = DummyProtocol()
+    builder = ChainBuilder(proto)
+    blocks = []
+    for i in range(20):
+        block = Block.create(chain, [])
+        chain = chain.try_append(block)
+        blocks.append(block)
+
+    # stored blocks are replayed by this program itself, starting with the head
+    for block in blocks[::-1]:
+        builder.new_block_received(block, True)
+    assert builder.primary_block_chain.head.hash == chain.head.hash
+    assert len(builder.primary_block_chain.blocks) == 21
+    assert proto.headers_requests == []
+
+@block_test()
+def test_unconfirmed_child_signatures(chain):
+    builder = ChainBuilder(DummyProtocol())
+    key = Signing.generate_private_key()
+    reward_trans = Transaction([], [TransactionTarget(key, chain.compute_blockreward_next_block())])
+    receive_blocks(builder, chain, [[reward_trans]])
+
+    parent = new_trans(reward_trans)
+    child = new_trans(parent)
+    builder.new_transaction_received(parent)
+    builder.new_transaction_received(child)
+    assert set(builder.unconfirmed_transactions) == {parent.get_hash(), child.get_hash()}
+
+    # a child of an unconfirmed transaction that is not signed by the recipient of its coin does
+    # not replace the signed one, even though it pays a higher fee
+    forged = Transaction([trans_as_input(parent)],
+                         [TransactionTarget(key, parent.targets[0].amount - 10)])
+    forged.sign([Signing.generate_private_key()])
+    builder.new_transaction_received(forged)
+    assert set(builder.unconfirmed_transactions) == {parent.get_hash(), child.get_hash()}
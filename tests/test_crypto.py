@@ -0,0 +1,48 @@
+import hashlib
+
+import pytest
+
+from .utils import *
+import src.signature_verification as sv
+from src.crypto import HASH_BACKENDS, set_hash_backend, _self_test
+
+def test_hash_backends():
+    block = Block.create(Blockchain(), [])
+    hashes = set()
+    try:
+        for name in HASH_BACKENDS:
+            set_hash_backend(name)
+            hashes.add(block._get_hash())
+    finally:
+        set_hash_backend(next(iter(HASH_BACKENDS)))
+    assert hashes == {block.hash}
+
+    with pytest.raises(ValueError):
+        set_hash_backend("md5")
+    assert not _self_test(hashlib.sha384)
+
+def test_parallel_signature_verification():
+    key = Signing.generate_private_key()
+    pubkey = Signing(key.as_bytes())
+    checks = []
+    for i in range(sv.MIN_PARALLEL_SIGNATURES * 2):
+        hashed_value = i.to_bytes(4, 'little')
+        checks.append((pubkey, hashed_value, key.sign(hashed_value)))
+    checks[5] = (pubkey, b"invalid", checks[5][2])
+
+    worker_count = sv._worker_count
+    sv.set_worker_count(3)
+    try:
+        assert sv.verify_signatures(checks) == [i != 5 for i in range(len(checks))]
+    finally:
+        sv.set_worker_count(worker_count)
+
+    # successful checks are cached, only the invalid signature needs to be verified again
+    verified = []
+    orig_verify_chunk = sv._verify_chunk
+    sv._verify_chunk = lambda chunk: verified.extend(chunk) or orig_verify_chunk(chunk)
+    try:
+        assert sv.verify_signatures(checks) == [i != 5 for i in range(len(checks))]
+    finally:
+        sv._verify_chunk = orig_verify_chunk
+    assert verified == [checks[5]]
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from .utils import *
+from .test_verifications import block_test
+from src.header_chain import HeaderChain
+from src.proof_of_work import DIFFICULTY_BLOCK_INTERVAL
+
+def forged_header(header, **fields):
+    obj = header.to_json_compatible()
+    obj.update(fields)
+    return BlockHeader.from_json_compatible(obj)
+
+@block_test()
+def test_header_chain(chain):
+    genesis_chain = chain
+    headers = []
+    for i in range(DIFFICULTY_BLOCK_INTERVAL + 2):
+        block = Block.create(chain, [], chain.head.time + timedelta(seconds=1))
+        chain = chain.try_append(block)
+        headers.append(block.get_header())
+    assert headers[-1].difficulty != headers[0].difficulty, "the difficulty was adjusted"
+
+    header_chain = HeaderChain(genesis_chain)
+    assert not header_chain.add(headers[1]), "the parent is not known yet"
+    for header in headers[:-3]:
+        assert header_chain.add(header)
+
+    retarget = headers[-3]
+    assert not header_chain.add(forged_header(retarget, difficulty=headers[0].difficulty,
+                                              height=headers[-4].height + headers[0].difficulty))
+    assert not header_chain.add(forged_header(retarget, height=retarget.height + 1))
+    assert not header_chain.add(forged_header(retarget, time=headers[0].to_json_compatible()['time']))
+    for header in headers[-3:]:
+        assert header_chain.add(header)
+    assert len(header_chain) == len(headers)
+
+    # headers that are part of the block chain or not higher than it are forgotten
+    header_chain.set_chain(chain.rollback(headers[-2].hash))
+    assert len(header_chain) == 1
+    assert headers[0].hash in header_chain and headers[-1].hash in header_chain
@@ -0,0 +1,73 @@
+from .utils import *
+from .test_verifications import trans_test
+from src.mempool import Mempool
+from src.mining_strategy import transaction_size
+
+@trans_test
+def test_mempool_dependencies(chain, reward_trans):
+    mempool = Mempool()
+    parent = new_trans(reward_trans, fee=2)
+    child = new_trans(parent, fee=1)
+    assert not mempool.add(child, chain), "the parent is not known yet"
+    assert mempool.add(parent, chain)
+    assert mempool.add(child, chain)
+
+    assert mempool.get_spender(trans_as_input(reward_trans)) == parent.get_hash()
+    assert mempool.get_entry(parent.get_hash()).fee == 2
+    assert mempool.get_entry(parent.get_hash()).children == {child.get_hash()}
+    assert mempool.get_entry(child.get_hash()).parents == {parent.get_hash()}
+    assert mempool.total_size == transaction_size(parent) + transaction_size(child)
+
+    # the child is kept when its parent is confirmed
+    assert mempool.remove(parent.get_hash()) == [parent]
+    assert mempool.get_entry(child.get_hash()).parents == set()
+    assert list(mempool) == [child.get_hash()]
+
+@trans_test
+def test_mempool_conflicts(chain, reward_trans):
+    mempool = Mempool()
+    cheap = new_trans(reward_trans, fee=1)
+    child = new_trans(cheap)
+    expensive = new_trans(reward_trans, fee=5)
+    assert mempool.add(cheap, chain)
+    assert mempool.add(child, chain)
+
+    # the more profitable conflicting transaction replaces the other one and its descendants
+    assert mempool.add(expensive, chain)
+    assert set(mempool) == {expensive.get_hash()}
+    assert not mempool.add(cheap, chain)
+    assert mempool.total_size == transaction_size(expensive)
+
+@trans_test
+def test_mempool_rejected_replacement(chain, reward_trans):
+    mempool = Mempool()
+    parent = new_trans(reward_trans, fee=1)
+    child = new_trans(parent)
+    assert mempool.add(parent, chain)
+    assert mempool.add(child, chain)
+
+    # a transaction replacing its own ancestor is rejected without removing anything
+    key = Signing.generate_private_key()
+    amount = reward_trans.targets[0].amount + child.targets[0].amount - 100
+    cyclic = Transaction([trans_as_input(reward_trans), trans_as_input(child)],
+                         [TransactionTarget(key, amount)])
+    cyclic.sign([reward_trans.targets[0].recipient_pk, child.targets[0].recipient_pk])
+    assert not mempool.add(cyclic, chain)
+    assert set(mempool) == {parent.get_hash(), child.get_hash()}
+
+@trans_test
+def test_mempool_eviction(chain, reward_trans):
+    key = reward_trans.targets[0].recipient_pk
+    split = Transaction([trans_as_input(reward_trans)],
+                        [TransactionTarget(key, 100) for _ in range(3)] +
+                        [TransactionTarget(key, reward_trans.targets[0].amount - 300)])
+    split.sign([key])
+    chain = extend_blockchain(chain, [split])
+
+    transactions = [new_trans(split, i, fee=i + 1) for i in range(3)]
+    mempool = Mempool(2 * max(transaction_size(t) for t in transactions))
+    assert mempool.add(transactions[1], chain)
+    assert mempool.add(transactions[2], chain)
+    assert not mempool.add(transactions[0], chain), "the cheapest transaction is evicted"
+    assert not mempool.add(new_trans(transactions[2]), chain), "a child without fees is evicted"
+    assert set(mempool) == {transactions[1].get_hash(), transactions[2].get_hash()}
@@ -0,0 +1,110 @@
+import os
+import signal
+from binascii import hexlify
+from time import sleep
+
+from .utils import *
+from src.mining import Miner, start_process, mining_worker, send_message, MessageReader
+from src.proof_of_work import search_nonce, proof_of_work_target, verify_proof_of_work
+
+def test_search_nonce():
+    block = Block.create(Blockchain(), [])
+    block.difficulty = 7
+    hasher = block.get_partial_hash()
+    target = proof_of_work_target(block.difficulty)
+
+    for first_nonce, nonce_step in [(0, 1), (1, 3), (250, 1), (65500, 4), (2**40 - 70, 5)]:
+        count = 100
+        expected = []
+        for i in range(count):
+            block.nonce = first_nonce + i * nonce_step
+            block.hash = block.finish_hash(hasher.copy())
+            if verify_proof_of_work(block):
+                expected.append(block.nonce)
+
+        found = []
+        nonce = first_nonce
+        end = first_nonce + count * nonce_step
+        while True:
+            nonce = search_nonce(hasher, target, nonce, nonce_step, (end - nonce) // nonce_step)
+            if nonce is None:
+                break
+            found.append(nonce)
+            nonce += nonce_step
+        assert found == expected
+
+def test_mining_worker():
+    block = Block.create(Blockchain(), [])
+    wx, rx, pid = start_process(mining_worker)
+    reader = MessageReader(rx)
+    try:
+        def send_work(work_id, difficulty):
+            block.difficulty = difficulty
+            send_message(wx, {'work_id': work_id, 'header': hexlify(block.get_partial_header()).decode(),
+                              'difficulty': difficulty, 'first_nonce': 1, 'nonce_step': 2})
+
+        def read_results():
+            """ Waits for found nonces, returning them and the hash reports received before. """
+            results, reports = [], []
+            while not results:
+                messages = reader.read(10)
+                assert messages, "the worker should report back"
+                results.extend(msg for msg in messages if 'nonce' in msg)
+                reports.extend(msg for msg in messages if 'hashes' in msg)
+            return results, reports
+
+        # the work with the impossible difficulty must be replaced by the next one
+        send_work(1, 2 ** 500)
+        send_work(2, 50)
+        results, reports = read_results()
+        assert [msg['work_id'] for msg in results] == [2]
+        assert reports and reports[-1]['work_id'] == 2
+        send_work(3, 1000)
+        messages, _ = read_results()
+        assert [msg['work_id'] for msg in messages] == [3]
+
+        block.nonce = messages[0]['nonce']
+        block.hash = block._get_hash()
+        assert block.nonce % 2 == 1
+        assert verify_proof_of_work(block)
+    finally:
+        os.close(wx)
+        os.close(rx)
+
+def test_new_work_delay():
+    miner = Miner(DummyProtocol(), Signing.generate_private_key(), worker_count=2)
+    miner._chain_change_work_id = 1
+
+    # repeated reports of the same worker do not count as the other worker switching
+    miner._hashes_reported(0, 1, 10)
+    miner._hashes_reported(0, 1, 10)
+    assert miner.new_work_delay is None
+
+    # the other worker may switch to newer work right away
+    miner._hashes_reported(1, 2, 10)
+    assert miner.new_work_delay is not None
+    assert miner.total_hashes == 30
+
+def test_miner_shutdown():
+    miner = Miner(DummyProtocol(), Signing.generate_private_key(), worker_count=2)
+    miner.start_mining()
+    worker_pids = list(miner._worker_pids)
+
+    # a process forked later on (like the signature verification pool) keeps the work pipes open
+    pid = os.fork()
+    if pid == 0:
+        sleep(10)
+        os._exit(0)
+    try:
+        miner.shutdown()
+        for worker_pid in worker_pids:
+            for _ in range(100):
+                try:
+                    os.kill(worker_pid, 0)
+                except ProcessLookupError:
+                    break
+                sleep(0.01)
+            else:
+                assert False, "the worker is still running"
+    finally:
+        os.kill(pid, signal.SIGKILL)
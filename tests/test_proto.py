@@ -14,7 +14,7 @@ def test_proto():
     proto1 = Protocol([], GENESIS_BLOCK, 1337)
     proto2 = Protocol([("127.0.0.1", 1337)], GENESIS_BLOCK, 1338)
     miner1 = Miner(proto1, reward_key)
-    miner2 = Miner(proto2, reward_key)
+    miner2 = Miner(proto2, reward_key, template_fee_delta=0)
     miner2.start_mining()
     miner1.start_mining()
 
@@ -37,10 +37,15 @@ def test_proto():
         chain_len2 = len(miner2.chainbuilder.primary_block_chain.blocks)
         print("Length of chain of miner 1: {}".format(chain_len1))
         print("Length of chain of miner 2: {}".format(chain_len2))
+        info1 = miner1.mining_info()
+        info2 = miner2.mining_info()
     finally:
         miner1.shutdown()
         miner2.shutdown()
 
+    assert info1['total_hashes'] > 0 and info1['hashrate'] > 0, "miner 1 should report its hashes"
+    assert info1['blocks_found'] + info2['blocks_found'] > 0, "some blocks should have been found"
+
     assert max(chain_len1, chain_len2) * 90 // 100 < min(chain_len1, chain_len2), "chain lengths are VERY different"
 
     chain1 = miner1.chainbuilder.primary_block_chain
@@ -51,3 +56,65 @@ def test_proto():
     assert not trans.verify(miner1.chainbuilder.primary_block_chain, set()), "inserted transaction should be spent and therefore invalid"
 
     assert TransactionInput(trans.get_hash(), 0) in chain1.unspent_coins, "someone spent our coins?"
+
+class FakePeer:
+    """ A connected peer that records the messages sent to it. """
+
+    def __init__(self, name, best_height=None, response_time=None):
+        self.peer_addr = name
+        self.is_connected = True
+        self.downloads = set()
+        self.best_height = best_height
+        self.response_time = response_time
+        self.sent = []
+
+    def send_msg(self, msg_type, msg_param):
+        self.sent.append((msg_type, msg_param['block_hash']))
+
+def test_block_download_scheduler():
+    from binascii import hexlify
+    import src.protocol
+    proto = Protocol([], GENESIS_BLOCK, 0)
+    silent = FakePeer("silent")
+    slow = FakePeer("slow", 10, 5.0)
+    fast = FakePeer("fast", 10, 1.0)
+    proto.peers = [silent, slow, fast]
+
+    hashes = [bytes([i]) * 64 for i in range(4)]
+    for h in hashes:
+        proto.send_block_request(h, [GENESIS_BLOCK.hash])
+    # the fast peer that announced blocks gets requests until it has too many of them
+    assert [len(p.sent) for p in proto.peers] == [0, 0, 4]
+    proto.send_block_request(b"x" * 64, [GENESIS_BLOCK.hash])
+    assert [len(p.sent) for p in proto.peers] == [0, 1, 4]
+
+    # an answered request is no longer in flight, unanswered ones go to another peer on timeout
+    proto._block_download_finished(hashes[0], fast)
+    assert fast.downloads == set(hashes[1:])
+    before = {h: d.peer for h, d in proto._block_downloads.items()}
+    for download in proto._block_downloads.values():
+        download.sent_time -= src.protocol.BLOCK_DOWNLOAD_TIMEOUT
+    proto._reassign_expired_downloads()
+    assert all(d.peer is not before[h] for h, d in proto._block_downloads.items())
+    assert sum(len(p.downloads) for p in proto.peers) == 4
+    assert slow.response_time == fast.response_time == src.protocol.BLOCK_DOWNLOAD_TIMEOUT
+    proto.server.shutdown()
+
+def test_prevalidation_order():
+    import time
+    proto = Protocol([], GENESIS_BLOCK, 0)
+    handled = []
+    proto._queue_callback = lambda msg_type, msg_param, peer, prio: handled.append(msg_type)
+    peer = FakePeer("peer")
+    genesis = GENESIS_BLOCK.to_json_compatible()
+
+    # the small block message must not overtake the large one, nor the transaction in between
+    proto.received('blocks', [genesis] * 100, peer)
+    proto.received('transaction', None, peer)
+    proto.received('block', genesis, peer)
+    deadline = time.monotonic() + 30
+    while (len(handled) < 3 or proto._prevalidation_tails) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert handled == ['blocks', 'transaction', 'block']
+    assert proto._prevalidation_tails == {}
+    proto.server.shutdown()
@@ -0,0 +1,42 @@
+import random
+
+from .utils import *
+from src.unspent_coins import UnspentCoins
+
+def test_unspent_coins_layers():
+    rand = random.Random(42)
+    coins = UnspentCoins()
+    reference = {}
+    history = [(coins, dict(reference))]
+
+    for block in range(300):
+        delta = {}
+        for inp in rand.sample(sorted(reference), min(len(reference), 3)):
+            delta[inp] = None
+        for i in range(rand.randint(1, 4)):
+            delta[TransactionInput(block.to_bytes(4, 'little'), i)] = \
+                    TransactionTarget(rand.choice("abcde"), rand.randint(1, 100))
+
+        coins = coins.apply(delta)
+        for inp, outp in delta.items():
+            if outp is None:
+                del reference[inp]
+            else:
+                reference[inp] = outp
+        history.append((coins, dict(reference)))
+
+    # older sets must not be affected by changes on top of them
+    for coins, reference in history:
+        assert len(coins) == len(reference)
+        assert dict(coins.items()) == reference
+        for recipient_pk in "abcdef":
+            expected = {inp: outp for inp, outp in reference.items() if outp.recipient_pk == recipient_pk}
+            assert dict(coins.get_coins_by_recipient(recipient_pk)) == expected
+            assert coins.get_balance(recipient_pk) == sum(outp.amount for outp in expected.values())
+
+    depth = 0
+    layer = coins
+    while layer is not None:
+        depth += 1
+        layer = layer._parent
+    assert depth <= 10
@@ -236,3 +236,160 @@ def test_invalid_height_difficulty(chain):
     block = create_block(chain, height=chain.head.height + chain.head.difficulty - 1,
                                 difficulty=chain.head.difficulty - 1)
     assert chain.try_append(block) is None
+
+@block_test()
+def test_forked_chains(chain):
+    def extend(chain, ts):
+        return chain.try_append(Block.create(chain, [], datetime.utcfromtimestamp(ts)))
+
+    chains = [chain]
+    for i in range(12):
+        chain = extend(chain, 0)
+        # the second extension of the same chain forks off a new branch
+        chains.append(extend(chain, 1))
+        chain = extend(chain, 2)
+        chains.append(chain)
+
+    for c in chains:
+        blocks = list(c.blocks)
+        assert len(blocks) == len(c.blocks)
+        assert blocks[0] is GENESIS_BLOCK
+        for idx, block in enumerate(blocks):
+            assert c.get_block_by_hash(block.hash) is block
+            if idx:
+                assert block.prev_block_hash == blocks[idx - 1].hash
+        for other in chains:
+            if other.head not in blocks:
+                assert c.get_block_by_hash(other.head.hash) is None
+
+@block_test()
+def test_flattened_block_store(chain):
+    from src.blockchain import _BlockStore, MAX_BLOCK_STORE_DEPTH
+    key = Signing.generate_private_key()
+    def extend(chain, iv):
+        reward = Transaction([], [TransactionTarget(key, chain.compute_blockreward_next_block())], iv=iv)
+        return chain.try_append(Block.create(chain, [reward]))
+
+    for i in range(30):
+        chain = extend(chain, b"")
+    first_fork = len(chain.blocks)
+
+    # each fork off the current branch nests the block stores one level deeper
+    copied = []
+    orig_append = _BlockStore.append
+    def append(store, block, undo):
+        if store.blocks:
+            copied.append(len(store))
+        orig_append(store, block, undo)
+    _BlockStore.append = append
+    try:
+        for i in range(2 * MAX_BLOCK_STORE_DEPTH):
+            extend(chain, b"a")
+            chain = extend(chain, b"b")
+            assert chain.blocks._store.depth <= MAX_BLOCK_STORE_DEPTH
+    finally:
+        _BlockStore.append = orig_append
+
+    # flattening copies the blocks of the nested stores, but never those of the root store
+    assert copied and min(copied) >= first_fork
+    blocks = list(chain.blocks)
+    for idx, block in enumerate(blocks[1:], 1):
+        assert chain.get_block_by_hash(block.hash) is block
+        assert block.prev_block_hash == blocks[idx - 1].hash
+
+@trans_test
+def test_rollback(chain, reward_trans):
+    trans1 = new_trans(reward_trans)
+    chain1 = extend_blockchain(chain, [trans1])
+    chain2 = extend_blockchain(chain1, [])
+
+    rolled_back = chain2.rollback(chain.head.hash)
+    assert list(rolled_back.blocks) == list(chain.blocks)
+    assert dict(rolled_back.unspent_coins.items()) == dict(chain.unspent_coins.items())
+    assert trans_as_input(reward_trans) in rolled_back.unspent_coins
+    assert trans_as_input(trans1) not in rolled_back.unspent_coins
+
+    # the rolled back chain can be extended with a competing block
+    trans2 = new_trans(reward_trans)
+    chain3 = extend_blockchain(rolled_back, [trans2])
+    assert trans_as_input(trans2) in chain3.unspent_coins
+    assert chain2.rollback(GENESIS_BLOCK_HASH).head is GENESIS_BLOCK
+
+    key = reward_trans.targets[0].recipient_pk
+    assert chain2.get_transaction_history(key) == [(1, reward_trans), (2, trans1)]
+    assert rolled_back.get_transaction_history(key) == [(1, reward_trans)]
+    assert chain3.get_transaction_history(key) == [(1, reward_trans), (2, trans2)]
+    assert chain3.get_transaction_history(trans1.targets[0].recipient_pk) == []
+    assert chain2.rollback(b"unknown") is None
+
+@trans_test
+def test_repeated_rollback(chain, reward_trans):
+    import math
+    orphaned = []
+    for i in range(20):
+        chain = extend_blockchain(chain, [])
+        orphan_trans = Transaction([], [TransactionTarget(reward_trans.targets[0].recipient_pk, 1)],
+                                   iv=bytes([i]))
+        orphaned.append(TransactionInput(orphan_trans.get_hash(), 0))
+        fork = extend_blockchain(chain, [orphan_trans])
+        fork = extend_blockchain(fork, [])
+        chain = fork.rollback(chain.head.hash)
+
+    # the layers of the unspent coins neither grow nor keep the coins of orphaned blocks alive
+    layers = []
+    layer = chain.unspent_coins
+    while layer is not None:
+        layers.append(layer)
+        layer = layer._parent
+    assert sum(l._block_count for l in layers) == len(chain.blocks) - 1
+    assert len(layers) <= math.log2(len(chain.blocks)) + 2
+    assert not any(inp in l._delta for l in layers for inp in orphaned)
+    assert trans_as_input(reward_trans) in chain.unspent_coins
+
+@trans_test
+def test_shallow_rollback_cost(chain, reward_trans):
+    from src.blockchain import BlockList
+    for _ in range(1023):
+        chain = extend_blockchain(chain, [])
+    trans1 = new_trans(reward_trans)
+    long_chain = extend_blockchain(extend_blockchain(chain, []), [trans1])
+    assert len(long_chain.blocks) == 1027
+
+    # rolling back two blocks must not replay the blocks of the rest of the chain
+    accessed = []
+    orig_getitem, orig_get_undo = BlockList.__getitem__, BlockList.get_undo
+    BlockList.__getitem__ = lambda self, idx: accessed.append(idx) or orig_getitem(self, idx)
+    BlockList.get_undo = lambda self, idx: accessed.append(idx) or orig_get_undo(self, idx)
+    try:
+        rolled_back = long_chain.rollback(chain.head.hash)
+    finally:
+        BlockList.__getitem__, BlockList.get_undo = orig_getitem, orig_get_undo
+    assert len(accessed) <= 4
+
+    assert rolled_back.head is chain.head
+    assert dict(rolled_back.unspent_coins.items()) == dict(chain.unspent_coins.items())
+    assert trans_as_input(trans1) not in rolled_back.unspent_coins
+    layers = []
+    layer = rolled_back.unspent_coins
+    while layer is not None:
+        layers.append(layer)
+        layer = layer._parent
+    assert sum(l._block_count for l in layers) == len(rolled_back.blocks) - 1
+
+@trans_test
+def test_create_block_by_fee(chain, reward_trans):
+    from src.mining_strategy import create_block, transaction_size
+    reward_key = Signing.generate_private_key()
+    cheap = new_trans(reward_trans, fee=1)
+    expensive = new_trans(reward_trans, fee=5)
+    child = new_trans(expensive)
+
+    block = create_block(chain, [cheap, child, expensive], reward_key)
+    assert block.transactions[:-1] == [expensive]
+    assert block.transactions[-1].targets[0].amount == chain.compute_blockreward_next_block() + 5
+    assert extend_blockchain(chain, block.transactions) is not None
+
+    # transactions exceeding the size limit are skipped
+    max_size = min(transaction_size(cheap), transaction_size(expensive)) - 1
+    block = create_block(chain, [cheap, expensive], reward_key, max_size)
+    assert block.transactions[:-1] == []
@@ -40,3 +40,27 @@ def new_trans(old_trans, out_idx=0, fee=0):
                         [TransactionTarget(key, amount)])
     trans.sign([old_trans.targets[out_idx].recipient_pk])
     return trans
+
+class DummyProtocol:
+    """ A protocol that is not connected to any peers. """
+
+    def __init__(self):
+        self.block_receive_handlers = []
+        self.blocks_receive_handlers = []
+        self.headers_receive_handlers = []
+        self.trans_receive_handlers = []
+        self.block_request_handlers = []
+        self.block_requests = []
+        self.headers_requests = []
+
+    def send_block_request(self, block_hash, locator=()):
+        self.block_requests.append((block_hash, set(locator)))
+
+    def send_headers_request(self, block_hash, locator=()):
+        self.headers_requests.append((block_hash, set(locator)))
+
+    def broadcast_transaction(self, transaction):
+        pass
+
+    def broadcast_primary_block(self, block):
+        pass
@@ -85,6 +85,9 @@ def main():
     subparsers.add_parser("show-network",
                           help="Prints networking information about the miner.")
 
+    subparsers.add_parser("show-mining",
+                          help="Prints mining statistics of the miner.")
+
     transfer = subparsers.add_parser("transfer", help="Transfer money.")
     transfer.add_argument("--private-key", type=private_signing,
                           default=[], action="append", required=False,
@@ -125,6 +128,14 @@ def main():
         for k, v in rpc.network_info():
             print("{}\t{}".format(k, v))
 
+    def mining_info():
+        info = rpc.mining_info()
+        if info is None:
+            print("the miner does not mine")
+            return
+        for k, v in sorted(info.items()):
+            print("{}\t{}".format(k, v))
+
     def transfer(targets: List[TransactionTarget], change_key: Optional[Signing],
                  wallet_keys: List[Signing], wallet_path: str, priv_keys: List[Signing]):
         if not change_key:
@@ -157,6 +168,8 @@ def main():
         show_balance(get_keys(args.key))
     elif args.command == 'show-network':
         network_info()
+    elif args.command == 'show-mining':
+        mining_info()
     elif args.command == 'transfer':
         if len(args.target) % 2:
             print("Missing amount to transfer for last target key.\n", file=sys.stderr)